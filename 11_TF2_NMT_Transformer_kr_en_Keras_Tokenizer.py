@@ -1,6 +1,11 @@
 import os
 import re
 import time
+import sys
+import json
+import tempfile
+import subprocess
+import resource
 import numpy as np
 import matplotlib.pyplot as plt
 import tensorflow as tf
@@ -16,15 +21,43 @@ print("Tensorflow version {}".format(tf.__version__))
 tf.random.set_seed(1234)
 AUTO = tf.data.experimental.AUTOTUNE
 
+# Multi-worker 학습 : TF_CONFIG 가 있으면 MultiWorkerMirroredStrategy 로 여러 프로세스가 함께 학습한다.
+# MultiWorkerMirroredStrategy 는 다른 연산보다 먼저 만들어야 하므로 스크립트 맨 앞에서 만든다.
+TF_CONFIG = json.loads(os.environ.get('TF_CONFIG', '{}'))
+USE_MULTI_WORKER = bool(TF_CONFIG)
+if USE_MULTI_WORKER:
+    strategy = tf.distribute.MultiWorkerMirroredStrategy()
+else:
+    strategy = tf.distribute.get_strategy()
+NUM_WORKERS = len(TF_CONFIG.get('cluster', {}).get('worker', [])) or 1
+TASK_INDEX = TF_CONFIG.get('task', {}).get('index', 0)
+print("REPLICAS: {}".format(strategy.num_replicas_in_sync))
+
+# 로컬 시험용 : N_LOCAL_WORKERS 개의 worker 프로세스를 localhost 포트로 띄워 클러스터를 흉내낸다. (0 이면 단일 프로세스)
+N_LOCAL_WORKERS = int(os.environ.get('N_LOCAL_WORKERS', 0))
+
 
 # Maximum sentence length
 ENCODER_LEN = 100
 DECODER_LEN = ENCODER_LEN
 BATCH_SIZE  = 128
+# gradient accumulation : ACCUM_STEPS 개의 micro-batch 마다 optimizer step 한 번 (유효 배치 = BATCH_SIZE * ACCUM_STEPS)
+ACCUM_STEPS = 1
 BUFFER_SIZE = 20000
 
 N_EPOCHS = 20
 
+# 스크립트 끝의 속도/결과 비교(benchmark)는 오래 걸리고 메모리를 많이 쓰므로 필요할 때만 켠다.
+RUN_BENCHMARKS = False
+
+# Mixed precision : None(float32), 'mixed_float16'(GPU) 또는 'mixed_bfloat16'(CPU/TPU)
+MIXED_PRECISION = None
+if MIXED_PRECISION:
+    tf.keras.mixed_precision.set_global_policy(MIXED_PRECISION)
+
+# XLA : True 이면 train_step 을 jit_compile 로 컴파일한다. 배치 shape 이 고정되도록 마지막의 불완전한 배치는 버린다.
+USE_XLA = False
+
 import urllib3
 import zipfile
 import shutil
@@ -32,48 +65,133 @@ import pandas as pd
 
 pd.set_option('display.max_colwidth', None)
 
-http = urllib3.PoolManager()
-url = 'https://raw.githubusercontent.com/Huffon/pytorch-transformer-kor-eng/master/data/corpus.csv'
-filename = 'corpus.csv'
-path = os.getcwd()
-zipfilename = os.path.join(path, filename)
-with http.request('GET', url, preload_content=False) as r, open(zipfilename, 'wb') as out_file:       
-    shutil.copyfileobj(r, out_file)
-
-total_df = pd.read_csv('corpus.csv')
-
-total_df.rename(columns={"english": "SRC"}, errors="raise", inplace=True)
-total_df.rename(columns={"korean": "TRG"}, errors="raise", inplace=True)
-
-total_df["src_len"] = ""
-total_df["trg_len"] = ""
-total_df.head()
-
-for idx in range(len(total_df['SRC'])):
-    # initialize string
-    text_eng = str(total_df.iloc[idx]['SRC'])
-
-    # default separator: space
-    result_eng = len(text_eng.split())
-    total_df.at[idx, 'src_len'] = int(result_eng)
-
-    text_fra = str(total_df.iloc[idx]['TRG'])
-    # default separator: space
-    result_fra = len(text_fra.split())
-    total_df.at[idx, 'trg_len'] = int(result_fra)
-
-print('Translation Pair :',len(total_df)) # 리뷰 개수 출력
-
-total_df = total_df.drop_duplicates(subset = ["SRC"])
-print('Translation Pair :',len(total_df)) # 리뷰 개수 출력
-
-total_df = total_df.drop_duplicates(subset = ["TRG"])
-print('Translation Pair :',len(total_df)) # 리뷰 개수 출력
+import hashlib
+
+""" corpus resolver """
+# 로컬 cache 를 먼저 확인하고, cache 에 없을 때만 네트워크에서 받습니다.
+# CORPUS_PATH 환경 변수로 파일, 디렉토리 또는 file:// 경로를 지정하면 네트워크를 전혀 사용하지 않습니다.
+CORPUS_URL       = 'https://raw.githubusercontent.com/Huffon/pytorch-transformer-kor-eng/master/data/corpus.csv'
+CORPUS_SHA256    = os.environ.get('CORPUS_SHA256')
+CORPUS_OVERRIDE  = os.environ.get('CORPUS_PATH')
+CORPUS_CACHE_DIR = os.environ.get('CORPUS_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'tf2_nmt_kr_en'))
+
+def file_sha256(filename, block_size=1 << 20):
+    hasher = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+def resolve_corpus(url=CORPUS_URL, sha256=CORPUS_SHA256, override=CORPUS_OVERRIDE, cache_dir=CORPUS_CACHE_DIR):
+    """Return a local path to the corpus file, downloading only on a cache miss.
+    cache 는 내용의 sha256 을 파일 이름으로 하는 blobs/ 와 URL 별로 blob 을 가리키는 urls/ 로 구성됩니다.
+    sha256 을 지정하면 override 파일, cache, 새로 받은 파일 모두 checksum 을 검사합니다.
+    """
+    filename = url.rsplit('/', 1)[-1]
+
+    if override:
+        path = override[len('file://'):] if override.startswith('file://') else override
+        if os.path.isdir(path):
+            path = os.path.join(path, filename)
+        if not os.path.isfile(path):
+            raise FileNotFoundError('corpus override not found: %s' % path)
+        if sha256 and file_sha256(path) != sha256:
+            raise ValueError('checksum mismatch for %s' % path)
+        return path
+
+    blob_dir = os.path.join(cache_dir, 'blobs')
+    url_dir  = os.path.join(cache_dir, 'urls')
+    os.makedirs(blob_dir, exist_ok=True)
+    os.makedirs(url_dir, exist_ok=True)
+    url_index = os.path.join(url_dir, hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+    digest = sha256
+    if digest is None and os.path.exists(url_index):
+        with open(url_index, encoding='utf-8') as f:
+            digest = json.load(f)['sha256']
+
+    # cache hit: 내용이 blob 이름(sha256)과 일치할 때만 사용
+    if digest is not None:
+        blob = os.path.join(blob_dir, digest)
+        if os.path.isfile(blob):
+            if file_sha256(blob) == digest:
+                return blob
+            os.remove(blob)
+
+    # cache miss: 임시 파일로 받은 뒤 검증하고 blob 으로 옮깁니다.
+    print('Downloading corpus      :', url)
+    download = os.path.join(blob_dir, 'download.%d.tmp' % os.getpid())
+    http = urllib3.PoolManager()
+    with http.request('GET', url, preload_content=False) as r, open(download, 'wb') as out_file:
+        if r.status != 200:
+            raise IOError('failed to download %s (HTTP %d)' % (url, r.status))
+        shutil.copyfileobj(r, out_file)
+
+    digest = file_sha256(download)
+    if sha256 and digest != sha256:
+        os.remove(download)
+        raise ValueError('checksum mismatch for %s' % url)
+
+    blob = os.path.join(blob_dir, digest)
+    os.replace(download, blob)
+    with open(url_index, 'w', encoding='utf-8') as f:
+        json.dump({'url': url, 'sha256': digest}, f)
+    return blob
+
+filename = resolve_corpus()
+
+CHUNK_SIZE = 100000
+MIN_LEN    = 7
+MAX_LEN    = 20
+
+def load_corpus(filename, chunksize=CHUNK_SIZE, min_len=MIN_LEN, max_len=MAX_LEN):
+    """Stream a parallel corpus CSV and return the filtered, de-duplicated pairs.
+    파일을 chunk 단위로 읽어서 단어 수를 벡터 연산으로 계산하고,
+    SRC -> TRG 순서의 중복 제거와 min_len < 길이 <= max_len 필터를 chunk 마다 적용합니다.
+    중복 검사는 문장 대신 64bit hash 만 보관하므로 수천만 쌍의 corpus 도 처리할 수 있습니다.
+    결과는 전체를 한번에 읽어서 처리했을 때와 같은 행, 같은 순서입니다.
+    """
+    seen_src = set()
+    seen_trg = set()
+    counts   = [0, 0, 0]
+    frames   = []
+
+    reader = pd.read_csv(filename, usecols=['english', 'korean'], chunksize=chunksize)
+    for chunk in reader:
+        chunk = chunk.rename(columns={"english": "SRC", "korean": "TRG"}, errors="raise")
+        counts[0] += len(chunk)
+
+        # 앞선 chunk 와 현재 chunk 안에서 이미 나온 SRC 제거 (첫번째 행 유지)
+        src_hash = pd.util.hash_pandas_object(chunk['SRC'].astype(str), index=False)
+        is_new   = ~(src_hash.map(seen_src.__contains__) | src_hash.duplicated())
+        seen_src.update(src_hash[is_new])
+        chunk    = chunk[is_new.values]
+        counts[1] += len(chunk)
+
+        # SRC 중복이 제거된 행들에 대해 TRG 중복 제거
+        trg_hash = pd.util.hash_pandas_object(chunk['TRG'].astype(str), index=False)
+        is_new   = ~(trg_hash.map(seen_trg.__contains__) | trg_hash.duplicated())
+        seen_trg.update(trg_hash[is_new])
+        chunk    = chunk[is_new.values]
+        counts[2] += len(chunk)
+
+        # default separator: space
+        src_len = chunk['SRC'].astype(str).str.split().str.len()
+        trg_len = chunk['TRG'].astype(str).str.split().str.len()
+
+        # 그 결과를 새로운 변수에 할당합니다.
+        is_within_len = (min_len < src_len) & (src_len <= max_len) & (min_len < trg_len) & (trg_len <= max_len)
+        chunk = chunk[is_within_len].assign(src_len=src_len[is_within_len].astype('int16'),
+                                            trg_len=trg_len[is_within_len].astype('int16'))
+        frames.append(chunk)
+
+    for count in counts:
+        print('Translation Pair :', count) # 리뷰 개수 출력
+
+    return pd.concat(frames)
 
-# 그 결과를 새로운 변수에 할당합니다.
-is_within_len = (7 < total_df['src_len']) & (total_df['src_len'] <= 20) & (7 < total_df['trg_len']) & (total_df['trg_len'] <=20)
 # 조건를 충족하는 데이터를 필터링하여 새로운 변수에 저장합니다.
-total_df = total_df[is_within_len]
+total_df = load_corpus(filename)
 print('챗봇 샘플의 개수 :', len(total_df))
 
 train_data = total_df.sample(n=1024*8, # number of items from axis to return.
@@ -84,37 +202,47 @@ print('챗봇 샘플의 개수 :', len(train_data))
 
 print(train_data.isnull().sum())
 
-raw_src = []
-for sentence in train_data['SRC']:
-    sentence = sentence.lower().strip()
-    # creating a space between a word and the punctuation following it
-    # eg: "he is a boy." => "he is a boy ."
-    sentence = re.sub(r"([?.!,])", r" \1 ", sentence)
-    sentence = re.sub(r'[" "]+', " ", sentence)
-    # removing contractions
-    sentence = re.sub(r"i'm", "i am", sentence)
-    sentence = re.sub(r"he's", "he is", sentence)
-    sentence = re.sub(r"she's", "she is", sentence)
-    sentence = re.sub(r"it's", "it is", sentence)
-    sentence = re.sub(r"that's", "that is", sentence)
-    sentence = re.sub(r"what's", "that is", sentence)
-    sentence = re.sub(r"where's", "where is", sentence)
-    sentence = re.sub(r"how's", "how is", sentence)
-    sentence = re.sub(r"\'ll", " will", sentence)
-    sentence = re.sub(r"\'ve", " have", sentence)
-    sentence = re.sub(r"\'re", " are", sentence)
-    sentence = re.sub(r"\'d", " would", sentence)
-    sentence = re.sub(r"\'re", " are", sentence)
-    sentence = re.sub(r"won't", "will not", sentence)
-    sentence = re.sub(r"can't", "cannot", sentence)
-    sentence = re.sub(r"n't", " not", sentence)
-    sentence = re.sub(r"n'", "ng", sentence)
-    sentence = re.sub(r"'bout", "about", sentence)
-    # replacing everything with space except (a-z, A-Z, ".", "?", "!", ",")
-    sentence = re.sub(r"[^a-zA-Z?.!,]+", " ", sentence)
-    sentence = sentence.strip()
-    raw_src.append(sentence)
-
+""" English normalization """
+# 축약형 치환 규칙. 순서대로 적용했을 때의 결과를 기준으로 합니다.
+EN_CONTRACTIONS = [
+    ("i'm", "i am"), ("he's", "he is"), ("she's", "she is"), ("it's", "it is"),
+    ("that's", "that is"), ("what's", "that is"), ("where's", "where is"), ("how's", "how is"),
+    ("'ll", " will"), ("'ve", " have"), ("'re", " are"), ("'d", " would"),
+    ("won't", "will not"), ("can't", "cannot"), ("n't", " not"), ("n'", "ng"), ("'bout", "about"),
+]
+EN_CONTRACTION_TABLE = dict(EN_CONTRACTIONS)
+
+# 축약형은 두 번의 정규식 치환으로 바꿉니다.
+# 단어 전체 축약형(i'm ~ how's)의 결과는 뒤 규칙과 이어질 수 있으므로 ("don'that's" -> "don'that is" -> "do nothat is")
+# 먼저 따로 치환하고, 나머지 규칙은 한 번에 치환합니다.
+EN_WORD_CONTRACTION_RE = re.compile(r"i'm|she's|he's|it's|that's|what's|where's|how's")
+# "n'" 는 순차 적용에서 'll/'ve/'re/'d 가 먼저 바뀌므로 그 앞에서는 매칭하지 않습니다.
+EN_CONTRACTION_RE = re.compile(r"'ll|'ve|'re|'d|won't|can't|n't|n'(?!ll|ve|re|d)|'bout")
+# 알파벳 단어와 구두점(?.!,)을 각각 하나의 토큰으로 분리. 나머지 문자는 모두 공백으로 취급됩니다.
+EN_TOKEN_RE = re.compile(r"[a-zA-Z]+|[?.!,]")
+
+def normalize_en(sentence):
+    """Lowercase, expand contractions and space out punctuation.
+    eg: "He's a boy." => "he is a boy ."
+    """
+    sentence = sentence.lower()
+    for pattern in (EN_WORD_CONTRACTION_RE, EN_CONTRACTION_RE):
+        sentence = pattern.sub(lambda m: EN_CONTRACTION_TABLE[m.group()], sentence)
+    return " ".join(EN_TOKEN_RE.findall(sentence))
+
+def normalize_en_tf(sentences):
+    """Same normalization as normalize_en() on a string tensor, usable inside tf.data.map.
+    RE2 는 lookahead 를 지원하지 않으므로 축약형은 규칙 순서대로 배치 단위로 치환합니다.
+    """
+    sentences = tf.strings.lower(sentences, encoding='utf-8')
+    for pattern, rewrite in EN_CONTRACTIONS:
+        sentences = tf.strings.regex_replace(sentences, pattern, rewrite)
+    sentences = tf.strings.regex_replace(sentences, r"[^a-zA-Z?.!,]+", " ")
+    sentences = tf.strings.regex_replace(sentences, r"([?.!,])", r" \1 ")
+    sentences = tf.strings.regex_replace(sentences, r" +", " ")
+    return tf.strings.strip(sentences)
+
+raw_src = [normalize_en(sentence) for sentence in train_data['SRC']]
 raw_trg = []
 for sentence in train_data['TRG']:
     # 구두점에 대해서 띄어쓰기
@@ -146,12 +274,82 @@ trg_sentence  = raw_trg.apply(lambda x: "<SOS> "+ x + " <EOS>")
 filters = '!"#$%&()*+,-./:;=?@[\\]^_`{|}~\t\n'
 oov_token = '<unk>'
 
-# Define tokenizer
-SRC_tokenizer = tf.keras.preprocessing.text.Tokenizer(filters = filters, oov_token=oov_token)
-TRG_tokenizer = tf.keras.preprocessing.text.Tokenizer(filters = filters, oov_token=oov_token)
-
-SRC_tokenizer.fit_on_texts(src_sentence)
-TRG_tokenizer.fit_on_texts(trg_sentence)
+TOKENIZER_SETTINGS = {'type': 'keras', 'filters': filters, 'oov_token': oov_token}
+SPECIAL_WORDS = ['<sos>', '<eos>']
+
+def save_tokenizer(tokenizer, prefix):
+    with open(prefix + '.json', 'w', encoding='utf-8') as f:
+        f.write(tokenizer.to_json())
+
+def load_tokenizer(prefix):
+    with open(prefix + '.json', encoding='utf-8') as f:
+        return tf.keras.preprocessing.text.tokenizer_from_json(f.read())
+
+def build_tokenizers(sources, targets):
+    """Fit the Keras tokenizers and look up the ids of the special tokens."""
+    # Define tokenizer
+    src_tokenizer = tf.keras.preprocessing.text.Tokenizer(filters = filters, oov_token=oov_token)
+    trg_tokenizer = tf.keras.preprocessing.text.Tokenizer(filters = filters, oov_token=oov_token)
+
+    src_tokenizer.fit_on_texts(sources)
+    trg_tokenizer.fit_on_texts(targets)
+
+    special_tokens = {
+        'SRC': {word: src_tokenizer.word_index[word] for word in SPECIAL_WORDS if word in src_tokenizer.word_index},
+        'TRG': {word: trg_tokenizer.word_index[word] for word in SPECIAL_WORDS if word in trg_tokenizer.word_index},
+    }
+    return src_tokenizer, trg_tokenizer, special_tokens
+
+""" tokenizer artifact store """
+# 한 번 만든 tokenizer 를 corpus 와 설정의 hash 로 저장해두고 다음 실행부터는 불러옵니다.
+# 추론만 할 때는 load_tokenizers() 로 마지막에 저장한 tokenizer 를 corpus 없이 불러올 수 있습니다.
+TOKENIZER_DIR = os.path.join(os.getcwd(), 'tokenizers')
+
+def tokenizer_key(settings, sources, targets):
+    """Hash of the tokenizer settings and every sentence it is built from."""
+    hasher = hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8'))
+    for corpus in (sources, targets):
+        for sentence in corpus:
+            hasher.update(str(sentence).encode('utf-8'))
+            hasher.update(b'\n')
+        hasher.update(b'\0')
+    return hasher.hexdigest()[:16]
+
+def save_tokenizers(key, src_tokenizer, trg_tokenizer, special_tokens, settings):
+    """Write both vocabularies and config.json (written last, marks a complete artifact)."""
+    path = os.path.join(TOKENIZER_DIR, key)
+    os.makedirs(path, exist_ok=True)
+    save_tokenizer(src_tokenizer, os.path.join(path, 'src'))
+    save_tokenizer(trg_tokenizer, os.path.join(path, 'trg'))
+
+    config = {'settings': settings, 'special_tokens': special_tokens}
+    with open(os.path.join(path, 'config.json'), 'w', encoding='utf-8') as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+    with open(os.path.join(TOKENIZER_DIR, 'latest'), 'w', encoding='utf-8') as f:
+        f.write(key)
+
+def load_tokenizers(key=None):
+    """Load (src_tokenizer, trg_tokenizer, special_tokens). key 가 없으면 마지막으로 저장한 것을 불러옵니다."""
+    if key is None:
+        with open(os.path.join(TOKENIZER_DIR, 'latest'), encoding='utf-8') as f:
+            key = f.read().strip()
+    path = os.path.join(TOKENIZER_DIR, key)
+    with open(os.path.join(path, 'config.json'), encoding='utf-8') as f:
+        config = json.load(f)
+    return load_tokenizer(os.path.join(path, 'src')), load_tokenizer(os.path.join(path, 'trg')), config['special_tokens']
+
+def build_or_load_tokenizers(sources, targets, settings=TOKENIZER_SETTINGS):
+    key = tokenizer_key(settings, sources, targets)
+    if os.path.exists(os.path.join(TOKENIZER_DIR, key, 'config.json')):
+        print('Tokenizer 불러오기       :', key)
+        return load_tokenizers(key)
+
+    src_tokenizer, trg_tokenizer, special_tokens = build_tokenizers(sources, targets)
+    save_tokenizers(key, src_tokenizer, trg_tokenizer, special_tokens, settings)
+    print('Tokenizer 저장           :', key)
+    return src_tokenizer, trg_tokenizer, special_tokens
+
+SRC_tokenizer, TRG_tokenizer, special_tokens = build_or_load_tokenizers(src_sentence, trg_sentence)
 
 n_enc_vocab = len(SRC_tokenizer.word_index) + 1
 n_dec_vocab = len(TRG_tokenizer.word_index) + 1
@@ -184,23 +382,131 @@ for line in lines:
     print("txt_2_ids :", txt_2_ids)
     print("ids_2_txt :", ids_2_txt[0],"\n")
     
-# 토큰화 / 정수 인코딩 / 시작 토큰과 종료 토큰 추가 / 패딩
-tokenized_inputs  = SRC_tokenizer.texts_to_sequences(src_sentence)
-tokenized_outputs = TRG_tokenizer.texts_to_sequences(trg_sentence)
+""" memory-mapped token cache """
+# 토큰화한 데이터를 (flat token 배열 + 문장별 offsets) 형식으로 한 번만 저장하고,
+# 학습할 때는 np.memmap 으로 필요한 행만 읽어서 RAM 보다 큰 corpus 도 다룰 수 있게 합니다.
+TOKEN_CACHE_DIR   = os.path.join(os.getcwd(), 'token_cache')
+TOKEN_CACHE_DTYPE = np.uint16 if max(n_enc_vocab, n_dec_vocab) <= 2**16 else np.int32
+
+def write_token_cache(path, chunks, pad_values=None, dtype=TOKEN_CACHE_DTYPE):
+    """Write chunks of padded rows as flat token files plus row offsets.
+    chunks 는 {field 이름: (행 수, 길이) 배열} 의 iterable 이므로 chunk 단위로 나누어 쓸 수 있습니다.
+    각 행의 뒤쪽 패딩은 저장하지 않고, meta.json 은 마지막에 써서 완성된 cache 임을 표시합니다.
+    """
+    pad_values = pad_values or {}
+    os.makedirs(path, exist_ok=True)
+    files, offsets, widths = {}, {}, {}
+    n_rows = 0
+
+    for chunk in chunks:
+        for name, rows in chunk.items():
+            rows = np.asarray(rows)
+            if name not in files:
+                files[name]   = open(os.path.join(path, name + '.tokens'), 'wb')
+                offsets[name] = [np.zeros(1, dtype=np.int64)]
+                widths[name]  = rows.shape[1]
+
+            # 마지막 non-pad 토큰의 위치 + 1
+            not_pad = rows != pad_values.get(name, 0)
+            lengths = np.where(not_pad.any(axis=1), rows.shape[1] - np.argmax(not_pad[:, ::-1], axis=1), 0)
+
+            rows[np.arange(rows.shape[1]) < lengths[:, np.newaxis]].astype(dtype).tofile(files[name])
+            offsets[name].append(offsets[name][-1][-1] + np.cumsum(lengths, dtype=np.int64))
+        n_rows += len(rows)
+
+    for name in files:
+        files[name].close()
+        np.concatenate(offsets[name]).tofile(os.path.join(path, name + '.offsets'))
+
+    meta = {'n_rows': n_rows, 'dtype': np.dtype(dtype).name,
+            'fields': {name: {'width': widths[name], 'pad': int(pad_values.get(name, 0))} for name in files}}
+    with open(os.path.join(path, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=2)
+
+class TokenCache(object):
+    """Read-only, memory-mapped view of a cache written by write_token_cache()."""
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+
+        self.n_rows  = meta['n_rows']
+        self.fields  = meta['fields']
+        self.tokens  = {name: np.memmap(os.path.join(path, name + '.tokens'), dtype=meta['dtype'], mode='r')
+                        for name in self.fields}
+        self.offsets = {name: np.memmap(os.path.join(path, name + '.offsets'), dtype=np.int64, mode='r')
+                        for name in self.fields}
+
+    def shape(self, name):
+        return (self.n_rows, self.fields[name]['width'])
+
+    def lengths(self, name):
+        """Per-row lengths without the trailing padding, read from the offsets only."""
+        return np.diff(self.offsets[name])
+
+    def rows(self, name, indices):
+        """Padded int64 rows for the given row indices."""
+        indices = np.asarray(indices, dtype=np.int64)
+        width   = self.fields[name]['width']
+        starts  = self.offsets[name][indices]
+        lengths = self.offsets[name][indices + 1] - starts
+
+        columns = np.arange(width)
+        in_row  = columns < lengths[:, np.newaxis]
+        rows = np.full((len(indices), width), self.fields[name]['pad'], dtype=np.int64)
+        rows[in_row] = self.tokens[name][(starts[:, np.newaxis] + columns)[in_row]]
+        return rows
+
+    def dataset(self, names, block_size=1024, num_shards=1, shard_index=0):
+        """tf.data pipeline of padded rows, read lazily block_size rows at a time.
+        num_shards / shard_index 로 block 단위로 나눠 worker 마다 서로 다른 행을 읽게 할 수 있습니다.
+        """
+        def load_block(indices):
+            return tuple(self.rows(name, indices) for name in names)
+
+        def set_shapes(*rows):
+            for name, row in zip(names, rows):
+                row.set_shape([self.fields[name]['width']])
+            return rows
 
-# 패딩
-tkn_sources = tf.keras.preprocessing.sequence.pad_sequences(tokenized_inputs,  maxlen=ENCODER_LEN, padding='post', truncating='post')
-tkn_targets = tf.keras.preprocessing.sequence.pad_sequences(tokenized_outputs, maxlen=DECODER_LEN, padding='post', truncating='post')
+        dataset = tf.data.Dataset.range(self.n_rows).batch(block_size).shard(num_shards, shard_index)
+        dataset = dataset.map(lambda indices: tuple(tf.numpy_function(load_block, [indices], [tf.int64] * len(names))),
+                              num_parallel_calls=AUTO)
+        return dataset.unbatch().map(set_shapes)
 
-tkn_sources = tf.cast(tkn_sources, dtype=tf.int64)
-tkn_targets = tf.cast(tkn_targets, dtype=tf.int64)
+    def shard_rows(self, num_shards, shard_index, block_size=1024):
+        """Row indices that dataset(names, block_size, num_shards, shard_index) reads."""
+        rows = np.arange(self.n_rows)
+        return rows[rows // block_size % num_shards == shard_index]
 
-print('질문 데이터의 크기(shape) :', tkn_sources.shape)
-print('답변 데이터의 크기(shape) :', tkn_targets.shape)
+    def blocks(self, names, block_size=4096):
+        """Yield {name: padded rows} for consecutive blocks of rows."""
+        for start in range(0, self.n_rows, block_size):
+            indices = np.arange(start, min(start + block_size, self.n_rows))
+            yield {name: self.rows(name, indices) for name in names}
+
+# corpus, tokenizer 설정, 문장 길이가 같으면 같은 cache 를 사용합니다.
+TOKEN_CACHE_PATH = os.path.join(TOKEN_CACHE_DIR, tokenizer_key(
+    {'tokenizer': TOKENIZER_SETTINGS, 'encoder_len': ENCODER_LEN, 'decoder_len': DECODER_LEN}, raw_src, raw_trg))
+
+if not os.path.exists(os.path.join(TOKEN_CACHE_PATH, 'meta.json')):
+    # 토큰화 / 정수 인코딩 / 시작 토큰과 종료 토큰 추가 / 패딩
+    tokenized_inputs  = SRC_tokenizer.texts_to_sequences(src_sentence)
+    tokenized_outputs = TRG_tokenizer.texts_to_sequences(trg_sentence)
+
+    # 패딩
+    tkn_sources = tf.keras.preprocessing.sequence.pad_sequences(tokenized_inputs,  maxlen=ENCODER_LEN, padding='post', truncating='post')
+    tkn_targets = tf.keras.preprocessing.sequence.pad_sequences(tokenized_outputs, maxlen=DECODER_LEN, padding='post', truncating='post')
+
+    write_token_cache(TOKEN_CACHE_PATH, [{'src': tkn_sources, 'trg': tkn_targets}])
+
+token_cache = TokenCache(TOKEN_CACHE_PATH)
+
+print('질문 데이터의 크기(shape) :', token_cache.shape('src'))
+print('답변 데이터의 크기(shape) :', token_cache.shape('trg'))
 
 # 0번째 샘플을 임의로 출력
-print(tkn_sources[0])
-print(tkn_targets[0])
+print(token_cache.rows('src', [0])[0])
+print(token_cache.rows('trg', [0])[0])
 
 # Hyper-parameters
 n_layers  = 2     # 6
@@ -209,12 +515,215 @@ pf_dim    = 1024
 n_heads   = 8
 dropout   = 0.3
 
-dataset = tf.data.Dataset.from_tensor_slices((tkn_sources, tkn_targets))
-
-dataset = dataset.cache()
-dataset = dataset.shuffle(BUFFER_SIZE)
-dataset = dataset.batch(BATCH_SIZE)
-dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+# True 이면 셀프 어텐션의 WQ, WK, WV (인코더-디코더 어텐션은 WK, WV) 를 하나의 matmul 로 계산한다.
+# 합친 kernel 은 qkv_linear 하나의 변수로 저장되므로, USE_FUSED_QKV = False 로 저장한 체크포인트는
+# 그 설정으로 만든 모델에 불러온 뒤 fuse_attention_weights(기존 모델, 새 모델) 로 옮긴다.
+USE_FUSED_QKV = False
+
+# 어텐션을 key 블록 단위(online softmax)로 계산할 때의 블록 크기. None 이면 전체 logits 를 만든다.
+# attention weights 가 필요 없는 호출(return_weights=False)에만 쓰이며, ENCODER_LEN 을 크게 늘릴 때 peak 메모리를 줄인다.
+ATTENTION_CHUNK_SIZE = None
+
+""" sharded TFRecord export / import """
+# 토큰화된 문장 쌍을 여러 개의 TFRecord shard 로 저장하고, interleave 로 여러 파일을 병렬로 읽습니다.
+# 여러 worker 가 CSV 를 다시 읽지 않고 각자 다른 shard 를 읽을 수 있습니다. (gs:// 경로도 사용 가능)
+USE_TFRECORD      = False
+TFRECORD_DIR      = os.path.join(os.getcwd(), 'tfrecords')
+N_TFRECORD_SHARDS = 8
+
+def write_tfrecord_shards(path, chunks, pad_values=None, n_shards=N_TFRECORD_SHARDS):
+    """Write chunks of padded rows ({field 이름: 2D 배열}) to n_shards TFRecord files.
+    i 번째 문장은 i % n_shards 번째 shard 에 기록되고, 각 행의 뒤쪽 패딩은 저장하지 않습니다.
+    """
+    pad_values = pad_values or {}
+    tf.io.gfile.makedirs(path)
+    writers = [tf.io.TFRecordWriter(os.path.join(path, 'data-%05d-of-%05d.tfrecord' % (shard, n_shards)))
+               for shard in range(n_shards)]
+    widths = {}
+    n_rows = 0
+
+    for chunk in chunks:
+        chunk = {name: np.asarray(rows) for name, rows in chunk.items()}
+        for name, rows in chunk.items():
+            widths[name] = rows.shape[1]
+
+        for row in range(len(next(iter(chunk.values())))):
+            feature = {}
+            for name, rows in chunk.items():
+                ids = rows[row]
+                not_pad = np.flatnonzero(ids != pad_values.get(name, 0))
+                ids = ids[:not_pad[-1] + 1] if len(not_pad) else ids[:0]
+                feature[name] = tf.train.Feature(int64_list=tf.train.Int64List(value=ids))
+            example = tf.train.Example(features=tf.train.Features(feature=feature))
+            writers[n_rows % n_shards].write(example.SerializeToString())
+            n_rows += 1
+
+    for writer in writers:
+        writer.close()
+
+    meta = {'n_rows': n_rows, 'n_shards': n_shards,
+            'fields': {name: {'width': widths[name], 'pad': int(pad_values.get(name, 0))} for name in widths}}
+    with tf.io.gfile.GFile(os.path.join(path, 'meta.json'), 'w') as f:
+        f.write(json.dumps(meta, indent=2))
+
+def tfrecord_dataset(path, names, deterministic=True, num_input_shards=1, input_shard_index=0):
+    """Read the shards with parallel interleave and return padded rows for the given fields.
+    deterministic=False 이면 파일 순서를 섞고 먼저 준비된 레코드부터 내보내서 처리량을 높입니다.
+    num_input_shards / input_shard_index 로 worker 마다 서로 다른 파일을 읽게 할 수 있습니다.
+    """
+    with tf.io.gfile.GFile(os.path.join(path, 'meta.json')) as f:
+        fields = json.loads(f.read())['fields']
+    features = {name: tf.io.VarLenFeature(tf.int64) for name in names}
+
+    def parse(record):
+        example = tf.io.parse_single_example(record, features)
+        rows = []
+        for name in names:
+            width, pad = fields[name]['width'], fields[name]['pad']
+            row = tf.sparse.to_dense(example[name])
+            row = tf.pad(row, [[0, width - tf.shape(row)[0]]], constant_values=pad)
+            row.set_shape([width])
+            rows.append(row)
+        return tuple(rows)
+
+    files = tf.data.Dataset.list_files(os.path.join(path, 'data-*.tfrecord'), shuffle=not deterministic)
+    files = files.shard(num_input_shards, input_shard_index)
+    dataset = files.interleave(tf.data.TFRecordDataset, num_parallel_calls=AUTO, deterministic=deterministic)
+    return dataset.map(parse, num_parallel_calls=AUTO, deterministic=deterministic)
+
+def tfrecord_shard_rows(path, n_rows, num_input_shards=1, input_shard_index=0):
+    """Row indices that tfrecord_dataset(deterministic=True, num_input_shards, input_shard_index) reads."""
+    with tf.io.gfile.GFile(os.path.join(path, 'meta.json')) as f:
+        n_shards = json.loads(f.read())['n_shards']
+    # i 번째 행은 (i % n_shards) 번째 파일에 있고, 파일은 이름 순서대로 나눠진다.
+    rows = np.arange(n_rows)
+    return rows[rows % n_shards % num_input_shards == input_shard_index]
+
+if USE_TFRECORD:
+    TFRECORD_PATH = os.path.join(TFRECORD_DIR, os.path.basename(TOKEN_CACHE_PATH))
+    if not tf.io.gfile.exists(os.path.join(TFRECORD_PATH, 'meta.json')):
+        write_tfrecord_shards(TFRECORD_PATH, token_cache.blocks(('src', 'trg')),
+                              pad_values={name: field['pad'] for name, field in token_cache.fields.items()})
+
+# 길이가 비슷한 문장끼리 배치를 구성하여 패딩을 줄인다. (False : 모든 문장을 ENCODER_LEN으로 패딩)
+USE_BUCKETING = True
+# 버킷 경계가 고정되어 있으므로 배치의 길이는 (경계 - 1) 중 하나로 제한되고 train_step의 재트레이싱도 제한된다.
+BUCKET_BOUNDARIES = [boundary for boundary in (16, 24, 32, 48, 64) if boundary < ENCODER_LEN] + [ENCODER_LEN + 1]
+
+# 토큰 수 기준 배치 (fairseq 의 --max-tokens) : 배치 크기 x 배치 길이가 MAX_TOKENS 이하가 되도록 버킷마다 배치 크기를 정한다.
+# 짧은 문장의 버킷일수록 더 많은 문장을 담으므로 step 마다 계산량이 거의 일정해진다. (None : 모든 버킷에서 BATCH_SIZE 문장)
+MAX_TOKENS = None
+
+def bucket_batch_sizes(boundaries, max_tokens=None, batch_size=BATCH_SIZE):
+    if max_tokens is None:
+        return [batch_size] * (len(boundaries) + 1)
+    # pad_to_bucket_boundary 이므로 버킷의 길이는 (경계 - 1) 이다. 마지막 버킷은 ENCODER_LEN 보다 긴 문장용이라 비어 있다.
+    lengths = [boundary - 1 for boundary in boundaries] + [boundaries[-1] - 1]
+    return [max(1, max_tokens // length) for length in lengths]
+
+def sequence_length(seq):
+    # 마지막 non-zero 토큰의 위치 + 1
+    positions = tf.range(1, tf.shape(seq)[0] + 1)
+    return tf.reduce_max(positions * tf.cast(tf.not_equal(seq, 0), tf.int32))
+
+def add_lengths(src, trg):
+    # 행마다의 길이를 배치와 함께 넘겨 train_step 이 패딩 마스크를 만들 때 토큰을 다시 훑지 않게 한다.
+    return src, trg, sequence_length(src), sequence_length(trg)
+
+def trim_padding(src, trg, src_length, trg_length):
+    length = tf.maximum(src_length, trg_length)
+    return src[:length], trg[:length], src_length, trg_length
+
+# 버킷 배치는 cardinality를 알 수 없으므로, dataset 을 한 번 훑는 대신 token cache 의 행 길이로 배치 수를 계산한다.
+def bucket_counts(lengths):
+    """Return (버킷마다의 행 수, 버킷마다의 배치 크기). 버킷을 쓰지 않으면 전체를 버킷 하나로 본다."""
+    if not USE_BUCKETING:
+        return (np.array([len(lengths)]),
+                np.array([BATCH_SIZE if MAX_TOKENS is None else max(1, MAX_TOKENS // ENCODER_LEN)]))
+    # bucket_by_sequence_length 와 같이 boundaries[b - 1] <= 길이 < boundaries[b] 인 행이 b 번째 버킷에 들어간다.
+    buckets = np.searchsorted(BUCKET_BOUNDARIES, lengths, side='right')
+    return (np.bincount(buckets, minlength=len(BUCKET_BOUNDARIES) + 1),
+            np.array(bucket_batch_sizes(BUCKET_BOUNDARIES, MAX_TOKENS)))
+
+def count_batches(lengths):
+    # 버킷마다 남은 행은 drop_remainder 이면 버리고, 아니면 마지막 불완전한 배치가 된다.
+    counts, sizes = bucket_counts(lengths)
+    return int(np.sum(counts // sizes if USE_XLA else -(-counts // sizes)))
+
+# 행의 길이는 trim_padding 과 같이 source, target 중 긴 쪽이다.
+ROW_LENGTHS = np.maximum(token_cache.lengths('src'), token_cache.lengths('trg'))
+N_BATCHES = count_batches(ROW_LENGTHS)
+
+def shard_rows(num_shards, shard_index):
+    """Row indices of the token cache that input pipeline shard_index of num_shards reads."""
+    if USE_TFRECORD:
+        return tfrecord_shard_rows(TFRECORD_PATH, token_cache.n_rows, num_shards, shard_index)
+    return token_cache.shard_rows(num_shards, shard_index)
+
+def read_rows(num_shards=1, shard_index=0):
+    # multi-worker 에서는 worker(input pipeline) 마다 서로 다른 행을 읽는다. (TFRecord 는 N_TFRECORD_SHARDS >= NUM_WORKERS)
+    if USE_TFRECORD:
+        return tfrecord_dataset(TFRECORD_PATH, ('src', 'trg'),
+                                num_input_shards=num_shards, input_shard_index=shard_index)
+    return token_cache.dataset(('src', 'trg'), num_shards=num_shards, shard_index=shard_index)
+
+def make_dataset(input_context=None):
+    """Training pipeline of one input pipeline.
+    multi-worker 에서는 distribute_datasets_from_function 이 worker 마다 input_context 를 넘겨 부른다.
+    """
+    num_shards, shard_index, batch_size = 1, 0, BATCH_SIZE
+    if input_context is not None:
+        num_shards, shard_index = input_context.num_input_pipelines, input_context.input_pipeline_id
+        # BATCH_SIZE 는 replica 당 배치 크기이다.
+        batch_size = input_context.get_per_replica_batch_size(BATCH_SIZE * input_context.num_replicas_in_sync)
+
+    dataset = read_rows(num_shards, shard_index).shuffle(BUFFER_SIZE)
+    dataset = dataset.map(add_lengths, num_parallel_calls=AUTO)
+
+    if USE_BUCKETING:
+        dataset = dataset.map(trim_padding, num_parallel_calls=AUTO)
+        dataset = dataset.apply(tf.data.experimental.bucket_by_sequence_length(
+            element_length_func=lambda src, *_: tf.shape(src)[0],
+            bucket_boundaries=BUCKET_BOUNDARIES,
+            bucket_batch_sizes=bucket_batch_sizes(BUCKET_BOUNDARIES, MAX_TOKENS, batch_size),
+            pad_to_bucket_boundary=True,
+            drop_remainder=USE_XLA))
+    else:
+        dataset = dataset.batch(batch_size if MAX_TOKENS is None else max(1, MAX_TOKENS // ENCODER_LEN),
+                                drop_remainder=USE_XLA)
+
+    if input_context is not None:
+        # pipeline 은 step 마다 자기 replica 수만큼의 배치를 내므로, 모든 worker 가 N_BATCHES step 만 돌도록 자른다.
+        dataset = dataset.take(N_BATCHES * (input_context.num_replicas_in_sync // num_shards))
+
+    return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+if USE_MULTI_WORKER:
+    # worker 마다 읽는 행과 그 길이 분포가 달라 배치 수도 다르다. collective 연산이 멈추지 않도록 모든 worker 가
+    # 배치가 가장 적은 worker 의 step 수만큼만 돈다. (데이터를 반복하지 않고, 다른 worker 의 남는 배치만 버린다)
+    N_BATCHES = min(count_batches(ROW_LENGTHS[shard_rows(NUM_WORKERS, index)]) for index in range(NUM_WORKERS))
+    N_BATCHES //= strategy.num_replicas_in_sync // NUM_WORKERS
+
+dataset = make_dataset()
+
+# 패딩 비율과 배치당 토큰 수도 dataset 을 훑지 않고 행 길이와 버킷 표로 계산한다.
+def batch_shapes(lengths):
+    """Return (배치 크기, 배치 길이) arrays of every batch the pipeline makes from rows of these lengths."""
+    counts, sizes = bucket_counts(lengths)
+    # pad_to_bucket_boundary 이므로 배치 길이는 (버킷 경계 - 1), 버킷을 쓰지 않으면 ENCODER_LEN 이다.
+    widths = np.array(BUCKET_BOUNDARIES + BUCKET_BOUNDARIES[-1:]) - 1 if USE_BUCKETING else np.array([ENCODER_LEN])
+    rest = np.zeros_like(counts) if USE_XLA else counts % sizes
+    return (np.concatenate([np.repeat(sizes, counts // sizes), rest[rest > 0]]),
+            np.concatenate([np.repeat(widths, counts // sizes), widths[rest > 0]]))
+
+# source, target 모두 배치 길이로 채워지며, 뒤쪽 패딩이 아닌 토큰 수는 token cache 의 길이의 합이다.
+n_tokens     = int(token_cache.lengths('src').sum() + token_cache.lengths('trg').sum())
+batch_tokens = np.prod(batch_shapes(ROW_LENGTHS), axis=0)
+print('패딩 비율 (고정 길이) :', 1 - n_tokens / (token_cache.n_rows * (ENCODER_LEN + DECODER_LEN)))
+print('패딩 비율 (현재)      :', 1 - n_tokens / (2 * int(batch_tokens.sum())))
+
+# 배치마다 계산량이 얼마나 일정한지 확인 (배치 크기 x 배치 길이)
+print('배치당 토큰 수 (min / mean / max) :', batch_tokens.min(), batch_tokens.sum() // len(batch_tokens), batch_tokens.max())
 
 """ sinusoid position encoding """
 def get_sinusoid_encoding_table(position, hid_dim):
@@ -232,6 +741,22 @@ def get_sinusoid_encoding_table(position, hid_dim):
 
     return tf.cast(pos_encoding, dtype=tf.float32)
 
+# encoder, decoder (그리고 같은 프로세스에서 만든 다른 모델)는 hid_dim 마다 하나의 위치 표를 함께 쓴다.
+# 표는 처음 필요할 때 만들고, 더 긴 길이가 요청되면 두 배 이상으로 늘려 다시 만든다.
+POSITION_TABLES = {}
+
+def sinusoid_position_table(length, hid_dim):
+    """Shared (1, >= length, hid_dim) sinusoid table, built once per hid_dim and grown on demand."""
+    table = POSITION_TABLES.get(hid_dim)
+    if table is None or table.shape[1] < length:
+        if table is not None:
+            length = max(length, 2 * table.shape[1])
+        # tf.function 안에서 처음 불려도 eager 텐서로 만들어 다른 그래프에서도 쓸 수 있게 한다.
+        with tf.init_scope():
+            table = get_sinusoid_encoding_table(length, hid_dim)
+        POSITION_TABLES[hid_dim] = table
+    return table
+
 sample_pos_encoding = get_sinusoid_encoding_table(50, 128)
 
 plt.pcolormesh(sample_pos_encoding.numpy()[0], cmap='RdBu')
@@ -242,15 +767,32 @@ plt.colorbar()
 plt.show()
 
 """ attention pad mask """
-def create_padding_mask(seq):
-    seq = tf.cast(tf.math.equal(seq, 0), tf.float32)
+# 마스크는 bool 이며 True 인 위치를 가린다. 어텐션에서는 tf.where 로 가려진 logits 를 -1e9 로 바꾼다.
+def sequence_lengths(seq):
+    # 행마다 마지막 non-zero 토큰의 위치 + 1 : (batch_size,)
+    positions = tf.range(1, tf.shape(seq)[1] + 1)
+    return tf.reduce_max(positions * tf.cast(tf.not_equal(seq, 0), tf.int32), axis=-1)
+
+def create_padding_mask(seq, lengths=None):
+    # 패딩은 문장 뒤쪽에만 있으므로 행마다의 길이(lengths)로 마스크를 만든다.
+    # 길이를 이미 알고 있으면(디코딩 중인 출력 등) 토큰을 다시 훑지 않는다.
+    if lengths is None:
+        lengths = sequence_lengths(seq)
+    mask = tf.logical_not(tf.sequence_mask(lengths, tf.shape(seq)[1]))
     # (batch_size, 1, 1, key의 문장 길이)
-    return seq[:, tf.newaxis, tf.newaxis, :]
+    return mask[:, tf.newaxis, tf.newaxis, :]
 
 """ attention decoder mask """
+# 최대 길이의 룩어헤드 마스크를 한 번만 만들어 두고 필요한 크기만큼 잘라 쓴다.
+# 디코딩 출력은 시작 토큰을 포함해 DECODER_LEN + 1 까지 길어진다.
+MAX_MASK_LEN    = max(ENCODER_LEN, DECODER_LEN) + 1
+LOOK_AHEAD_MASK = tf.constant(np.triu(np.ones((MAX_MASK_LEN, MAX_MASK_LEN), dtype=bool), k=1))
+
 def create_look_ahead_mask(size):
-    mask = 1 - tf.linalg.band_part(tf.ones((size, size)), -1, 0)
-    return mask
+    # (size, size), 미래 위치가 True
+    # 표보다 긴 size 는 잘린 (틀린) 마스크가 되므로 MAX_MASK_LEN 을 넘으면 실패시킨다.
+    tf.debugging.assert_less_equal(size, MAX_MASK_LEN, message='create_look_ahead_mask: size > MAX_MASK_LEN')
+    return LOOK_AHEAD_MASK[:size, :size]
 
 """ scale dot product attention """
 def ScaledDotProductAttention(query, key, value, mask):
@@ -269,35 +811,139 @@ def ScaledDotProductAttention(query, key, value, mask):
         query: query shape == (batch_size, n_heads, seq_len_q, depth)
         key: key shape     == (batch_size, n_heads, seq_len_k, depth)
         value: value shape == (batch_size, n_heads, seq_len_v, depth_v)
-        mask: Float tensor with shape broadcastable
+        mask: Boolean tensor (True 인 위치를 가린다) with shape broadcastable
               to (batch_size, n_heads, seq_len_q, seq_len_k). Defaults to None.
 
     Returns:
         output, attention_weights
     """
     
-    matmul_qk = tf.matmul(query, key, transpose_b=True)  # (..., seq_len_q, seq_len_k)
+    # mixed precision 에서도 logits, mask, softmax 는 float32 로 계산한다. (-1e9 는 float16 범위를 넘는다)
+    matmul_qk = tf.cast(tf.matmul(query, key, transpose_b=True), tf.float32)  # (..., seq_len_q, seq_len_k)
 
     # scale matmul_qk
-    dk = tf.cast(tf.shape(key)[-1], tf.float32)
+    # depth 는 정적인 값이므로 상수로 계산한다.
+    dk = tf.cast(key.shape[-1], tf.float32)
     scaled_attention_logits = matmul_qk / tf.math.sqrt(dk)
 
-    # add the mask to the scaled tensor.
+    # mask the scaled tensor.
     if mask is not None:
-        scaled_attention_logits += (mask * -1e9)
+        scaled_attention_logits = tf.where(mask, -1e9, scaled_attention_logits)
 
     # softmax is normalized on the last axis (seq_len_k) so that the scores
     # add up to 1.
     attention_weights = tf.nn.softmax(scaled_attention_logits, axis=-1)  # (..., seq_len_q, seq_len_k)
 
-    output = tf.matmul(attention_weights, value)  # (..., seq_len_q, depth_v)
+    output = tf.matmul(tf.cast(attention_weights, value.dtype), value)  # (..., seq_len_q, depth_v)
 
     return output, attention_weights
 
+""" chunked dot product attention """
+def ChunkedDotProductAttention(query, key, value, mask, chunk_size, bias=None):
+    """Scaled dot product attention over blocks of chunk_size keys with online softmax.
+    (batch_size, n_heads, seq_len_q, seq_len_k) 크기의 logits, weights 를 만들지 않고,
+    backward 도 저장해 둔 output 과 logsumexp 로 블록마다 다시 계산한다. (flash attention 방식)
+
+    Args:
+        query, key, value, mask: ScaledDotProductAttention 과 같다.
+        chunk_size: 한 블록에서 처리할 key 의 개수
+        bias: logits 에 더할 (1, n_heads, seq_len_q, seq_len_k) 텐서. Defaults to None.
+
+    Returns:
+        output (attention weights 는 만들지 않는다)
+    """
+    seq_len_k = tf.shape(key)[2]
+    n_chunks  = (seq_len_k + chunk_size - 1) // chunk_size
+    n_pad     = n_chunks * chunk_size - seq_len_k
+
+    # key 길이를 chunk_size 의 배수로 맞춘다. 늘어난 위치는 -1e9 보다 작은 값으로 채워 모든 key 가 가려진
+    # query(패딩 위치)에서도 늘어난 key 는 확률 0 이 되어 기존 softmax 와 같은 값이 나온다.
+    if mask is None:
+        mask = tf.zeros((1, seq_len_k), dtype=tf.bool)
+    mask = tf.pad(mask, [[0, 0]] * (len(mask.shape) - 1) + [[0, n_pad]], constant_values=True)
+    in_range = tf.range(n_chunks * chunk_size) < seq_len_k
+    key   = tf.pad(key, [[0, 0], [0, 0], [0, n_pad], [0, 0]])
+    value = tf.pad(value, [[0, 0], [0, 0], [0, n_pad], [0, 0]])
+    if bias is None:
+        bias = tf.zeros((1, 1, 1, seq_len_k))
+    bias = tf.pad(tf.cast(bias, tf.float32), [[0, 0], [0, 0], [0, 0], [0, n_pad]])
+    bias_axes = [axis for axis in range(3) if bias.shape[axis] == 1]
+
+    scale = 1. / tf.math.sqrt(tf.cast(key.shape[-1], tf.float32))
+
+    def merge_chunks(chunks, axis):
+        # (n_chunks, ..., chunk_size, ...) -> (..., n_chunks * chunk_size, ...), axis 는 key 축
+        chunks = chunks.stack()
+        chunks = tf.transpose(chunks, list(range(1, axis + 1)) + [0] + list(range(axis + 1, 5)))
+        shape  = tf.shape(chunks)
+        return tf.reshape(chunks, tf.concat([shape[:axis], [-1], shape[axis + 2:]], axis=0))
+
+    @tf.custom_gradient
+    def attention(query, key, value, bias):
+        query_f = tf.cast(query, tf.float32)
+
+        def chunk(i):
+            start   = i * chunk_size
+            key_i   = tf.cast(key[:, :, start:start + chunk_size], tf.float32)
+            value_i = tf.cast(value[:, :, start:start + chunk_size], tf.float32)
+            # logits : (..., seq_len_q, chunk_size)
+            logits  = tf.matmul(query_f, key_i, transpose_b=True) * scale
+            logits  = tf.where(mask[..., start:start + chunk_size], -1e9, logits + bias[..., start:start + chunk_size])
+            logits  = tf.where(in_range[start:start + chunk_size], logits, -2e9)
+            return key_i, value_i, logits
+
+        # 블록마다 지금까지의 최대값(m), 지수합(l), 가중합(acc) 을 갱신한다.
+        # parallel_iterations=1 로 한 번에 한 블록의 logits 만 메모리에 있게 한다.
+        def forward_step(i, m, l, acc):
+            _, value_i, logits = chunk(i)
+            m_new = tf.maximum(m, tf.reduce_max(logits, axis=-1, keepdims=True))
+            p = tf.exp(logits - m_new)
+            correction = tf.exp(m - m_new)
+            l   = l * correction + tf.reduce_sum(p, axis=-1, keepdims=True)
+            acc = acc * correction + tf.matmul(p, value_i)
+            return i + 1, m_new, l, acc
+
+        stats_shape = tf.concat([tf.shape(query)[:3], [1]], axis=0)
+        _, m, l, acc = tf.while_loop(
+            lambda i, *_: i < n_chunks, forward_step,
+            [tf.constant(0), tf.fill(stats_shape, float('-inf')), tf.zeros(stats_shape),
+             tf.zeros(tf.concat([tf.shape(query)[:3], tf.shape(value)[3:]], axis=0))],
+            parallel_iterations=1)
+        output = acc / l
+        logsumexp = m + tf.math.log(l)
+
+        def grad(d_output):
+            d_output = tf.cast(d_output, tf.float32)
+            delta = tf.reduce_sum(d_output * output, axis=-1, keepdims=True)
+
+            def backward_step(i, d_query, d_keys, d_values, d_biases):
+                key_i, value_i, logits = chunk(i)
+                p  = tf.exp(logits - logsumexp)
+                ds = p * (tf.matmul(d_output, value_i, transpose_b=True) - delta)
+                d_query += tf.matmul(ds, key_i) * scale
+                d_keys   = d_keys.write(i, tf.matmul(ds, query_f, transpose_a=True) * scale)
+                d_values = d_values.write(i, tf.matmul(p, d_output, transpose_a=True))
+                d_biases = d_biases.write(i, tf.reduce_sum(ds, axis=bias_axes, keepdims=True))
+                return i + 1, d_query, d_keys, d_values, d_biases
+
+            _, d_query, d_keys, d_values, d_biases = tf.while_loop(
+                lambda i, *_: i < n_chunks, backward_step,
+                [tf.constant(0), tf.zeros_like(query_f)] +
+                [tf.TensorArray(tf.float32, size=n_chunks) for _ in range(3)],
+                parallel_iterations=1)
+            return (tf.cast(d_query, query.dtype),
+                    tf.cast(merge_chunks(d_keys, 2), key.dtype),
+                    tf.cast(merge_chunks(d_values, 2), value.dtype),
+                    merge_chunks(d_biases, 3))
+
+        return tf.cast(output, value.dtype), grad
+
+    return attention(query, key, value, bias)
+
 """ multi head attention """
 class MultiHeadAttentionLayer(tf.keras.layers.Layer):
     
-    def __init__(self, hid_dim, n_heads):
+    def __init__(self, hid_dim, n_heads, fused=None):
         super(MultiHeadAttentionLayer, self).__init__()
         self.n_heads = n_heads
         assert hid_dim % self.n_heads == 0
@@ -306,10 +952,19 @@ class MultiHeadAttentionLayer(tf.keras.layers.Layer):
         # hid_dim을 n_heads로 나눈 값.
         self.depth = int(hid_dim/self.n_heads)
         
+        # fused : None 이면 WQ, WK, WV를 각각 계산, 'qkv' 는 셀프 어텐션, 'kv' 는 key = value 인 인코더-디코더 어텐션용.
+        # 합친 kernel 은 qkv_linear 하나의 변수로 두어 호출할 때마다 q/k/v kernel 을 이어 붙이지 않는다.
+        self.fused = fused
+        
         # WQ, WK, WV에 해당하는 밀집층 정의
-        self.q_linear = tf.keras.layers.Dense(hid_dim)
-        self.k_linear = tf.keras.layers.Dense(hid_dim)
-        self.v_linear = tf.keras.layers.Dense(hid_dim)
+        # fused 이면 열 순서가 [WQ | WK | WV] ('kv' 는 [WK | WV]) 인 하나의 밀집층으로 계산한다.
+        if fused:
+            self.qkv_linear = tf.keras.layers.Dense(len(fused) * hid_dim)
+        if fused != 'qkv':
+            self.q_linear = tf.keras.layers.Dense(hid_dim)
+        if not fused:
+            self.k_linear = tf.keras.layers.Dense(hid_dim)
+            self.v_linear = tf.keras.layers.Dense(hid_dim)
         # WO에 해당하는 밀집층 정의
         self.out = tf.keras.layers.Dense(hid_dim)
 
@@ -321,29 +976,77 @@ class MultiHeadAttentionLayer(tf.keras.layers.Layer):
             inputs, (batch_size, -1, self.n_heads, self.depth))
         return tf.transpose(inputs, perm=[0, 2, 1, 3])
 
-    def call(self, value, key, query, mask):
+    def fused_projection(self, inputs, batch_size):
+        """Project inputs with the fused kernel (qkv_linear) in one matmul.
+        Split the result with one reshape/transpose into (len(self.fused), batch_size, n_heads, seq_len, depth)
+        """
+        # (batch_size, seq_len, len(self.fused) * hid_dim) : 열 순서가 [WQ | WK | WV] 이므로 reshape 한 번으로 나눌 수 있다.
+        outputs = self.qkv_linear(inputs)
+        outputs = tf.reshape(
+            outputs, (batch_size, -1, len(self.fused), self.n_heads, self.depth))
+        return tf.transpose(outputs, perm=[2, 0, 3, 1, 4])
+
+    def project_kv(self, value, key):
+        """WK, WV를 지난 뒤 헤드를 나눈 key, value를 반환한다.
+        디코딩 시 인코더 출력에 대한 key, value를 한 번만 계산하기 위해 사용한다.
+        """
+        batch_size = tf.shape(key)[0]
+        if self.fused == 'kv':
+            # 인코더-디코더 어텐션은 key = value (인코더 출력) 이므로 WK, WV를 한 번에 계산한다.
+            key, value = tf.unstack(self.fused_projection(key, batch_size))
+            return key, value
+        key   = self.split_heads(self.k_linear(key), batch_size)
+        value = self.split_heads(self.v_linear(value), batch_size)
+        return key, value
+
+    def call(self, value, key, query, mask, cache=None, static_kv=False, decode_step=None,
+             return_weights=True):
         batch_size = tf.shape(query)[0]
         # 1. WQ, WK, WV에 해당하는 밀집층 지나기
         # q : (batch_size, query의 문장 길이, hid_dim)
         # k : (batch_size, key의 문장 길이, hid_dim)
         # v : (batch_size, value의 문장 길이, hid_dim)
-        query = self.q_linear(query)
-        key   = self.k_linear(key)
-        value = self.v_linear(value)
-        
-        # 2. 헤드 나누기
-        # q : (batch_size, n_heads, query의 문장 길이, hid_dim/n_heads)
-        # k : (batch_size, n_heads, key의 문장 길이,   hid_dim/n_heads)
-        # v : (batch_size, n_heads, value의 문장 길이, hid_dim/n_heads)
-        query = self.split_heads(query, batch_size)
-        key   = self.split_heads(key, batch_size)
-        value = self.split_heads(value, batch_size)
+        if self.fused == 'qkv':
+            # 셀프 어텐션은 query = key = value 이므로 한 번의 matmul 과 reshape 로 헤드까지 나눈다.
+            query, key, value = tf.unstack(self.fused_projection(query, batch_size))
+        else:
+            query = self.q_linear(query)
+            
+            # 2. 헤드 나누기
+            # q : (batch_size, n_heads, query의 문장 길이, hid_dim/n_heads)
+            # k : (batch_size, n_heads, key의 문장 길이,   hid_dim/n_heads)
+            # v : (batch_size, n_heads, value의 문장 길이, hid_dim/n_heads)
+            query = self.split_heads(query, batch_size)
+
+        if cache is not None and static_kv:
+            # 디코더-인코더 어텐션 : 미리 계산해 둔 key, value를 그대로 사용
+            key, value = cache['key'], cache['value']
+        else:
+            if self.fused != 'qkv':
+                key, value = self.project_kv(value, key)
+
+            if cache is not None and decode_step is not None:
+                # 고정 크기 캐시 : decode_step 위치에 현재 시점의 key, value를 기록한다.
+                indices = tf.one_hot(decode_step, tf.shape(cache['key'])[2], dtype=key.dtype)
+                key   = cache['key'] + key * indices[:, tf.newaxis]
+                value = cache['value'] + value * indices[:, tf.newaxis]
+                cache['key'], cache['value'] = key, value
+            elif cache is not None:
+                # 셀프 어텐션 : 이전 시점까지의 key, value 뒤에 현재 시점의 key, value를 붙인다.
+                key   = tf.concat([cache['key'], key], axis=2)
+                value = tf.concat([cache['value'], value], axis=2)
+                cache['key'], cache['value'] = key, value
         
         # 3. 스케일드 닷 프로덕트 어텐션. 앞서 구현한 함수 사용.
         # (batch_size, n_heads, query의 문장 길이, hid_dim/n_heads)
         # attention_weights.shape == (batch_size, n_heads, seq_len_q, seq_len_k)
-        scaled_attention, attention_weights = ScaledDotProductAttention(
-            query, key, value, mask)
+        if not return_weights and ATTENTION_CHUNK_SIZE:
+            # weights 가 필요 없으면 key 블록 단위로 계산해 (batch_size, n_heads, seq_len_q, seq_len_k) 텐서를 만들지 않는다.
+            scaled_attention = ChunkedDotProductAttention(
+                query, key, value, mask, ATTENTION_CHUNK_SIZE)
+        else:
+            scaled_attention, attention_weights = ScaledDotProductAttention(
+                query, key, value, mask)
         
         # (batch_size, query의 문장 길이, n_heads, hid_dim/n_heads)
         scaled_attention = tf.transpose(scaled_attention, perm=[0, 2, 1, 3])
@@ -357,8 +1060,41 @@ class MultiHeadAttentionLayer(tf.keras.layers.Layer):
         # (batch_size, query의 문장 길이, hid_dim)
         outputs = self.out(concat_attention)
 
+        if not return_weights:
+            # 호출한 쪽이 weights 를 버리므로 그래프 출력으로 남기지 않는다.
+            return outputs, None
+
         return outputs, attention_weights
 
+def fuse_attention_weights(source, target):
+    """Copy the weights of `source` (built with USE_FUSED_QKV = False) into `target` of the same structure.
+    fused 어텐션 층의 qkv_linear 에는 WQ, WK, WV (또는 WK, WV) 의 kernel 과 bias 를 열 방향으로 이어 붙여 넣는다.
+    두 모델 모두 한 번 호출해 변수를 만든 뒤 사용한다.
+    """
+    def attention_layers(module):
+        return [layer for layer in [module] + list(module.submodules) if isinstance(layer, MultiHeadAttentionLayer)]
+
+    def projection_variables(layer):
+        return [var for name in ('qkv_linear', 'q_linear', 'k_linear', 'v_linear') if hasattr(layer, name)
+                for var in getattr(layer, name).variables]
+
+    source_layers, target_layers = attention_layers(source), attention_layers(target)
+    skip = {var.ref() for layer in source_layers + target_layers for var in projection_variables(layer)}
+    # 프로젝션 밀집층을 뺀 나머지 변수 (임베딩, WO, FFN, LayerNorm ...) 는 두 모델에서 순서가 같으므로 그대로 복사한다.
+    for source_var, target_var in zip([var for var in source.variables if var.ref() not in skip],
+                                      [var for var in target.variables if var.ref() not in skip]):
+        target_var.assign(source_var)
+
+    for src, dst in zip(source_layers, target_layers):
+        assert not src.fused
+        if dst.fused:
+            linears = (src.q_linear, src.k_linear, src.v_linear)[-len(dst.fused):]
+            dst.qkv_linear.kernel.assign(tf.concat([linear.kernel for linear in linears], axis=-1))
+            dst.qkv_linear.bias.assign(tf.concat([linear.bias for linear in linears], axis=-1))
+        for name in ('q_linear', 'k_linear', 'v_linear'):
+            if hasattr(dst, name):
+                getattr(dst, name).set_weights(getattr(src, name).get_weights())
+
 """ feed forward """
 class PositionwiseFeedforwardLayer(tf.keras.layers.Layer):
     def __init__(self, hid_dim, pf_dim):
@@ -376,7 +1112,7 @@ class EncoderLayer(tf.keras.layers.Layer):
     def __init__(self, pf_dim, hid_dim, n_heads, dropout):
         super(EncoderLayer, self).__init__()
         
-        self.attn = MultiHeadAttentionLayer(hid_dim, n_heads)
+        self.attn = MultiHeadAttentionLayer(hid_dim, n_heads, fused='qkv' if USE_FUSED_QKV else None)
         self.ffn = PositionwiseFeedforwardLayer(hid_dim, pf_dim)
         
         self.layernorm1 = tf.keras.layers.LayerNormalization(epsilon=1e-6)
@@ -386,7 +1122,8 @@ class EncoderLayer(tf.keras.layers.Layer):
         self.dropout2 = tf.keras.layers.Dropout(dropout)
 
     def call(self, inputs, training, padding_mask):
-        attention, _ = self.attn(inputs, inputs, inputs, padding_mask)  # (batch_size, input_seq_len, hid_dim)
+        attention, _ = self.attn(inputs, inputs, inputs, padding_mask,
+                                 return_weights=False)  # (batch_size, input_seq_len, hid_dim)
         attention   = self.dropout1(attention, training=training)
         attention   = self.layernorm1(inputs + attention)  # (batch_size, input_seq_len, hid_dim)
         
@@ -406,8 +1143,10 @@ class Encoder(tf.keras.layers.Layer):
         self.n_layers = n_layers
 
         self.embedding = tf.keras.layers.Embedding(n_enc_vocab, hid_dim)
-        self.pos_encoding = get_sinusoid_encoding_table(maximum_position_encoding,
-                                                self.hid_dim)
+        # 위치 표는 모든 encoder/decoder 가 함께 쓰는 표를 call 에서 가져온다.
+        # train_step 은 (None, None) shape 으로 트레이싱되어 입력 길이를 알 수 없으므로 표의 길이는 고정된 최대값이며,
+        # 디코딩 출력(MAX_MASK_LEN) 보다 짧지 않게 잡는다. 이보다 긴 입력은 call 에서 실패시킨다.
+        self.maximum_position_encoding = max(maximum_position_encoding, MAX_MASK_LEN)
 
         self.enc_layers = [EncoderLayer(pf_dim, hid_dim, n_heads, dropout)
                            for _ in range(n_layers)]
@@ -419,8 +1158,11 @@ class Encoder(tf.keras.layers.Layer):
 
         # adding embedding and position encoding.
         emb = self.embedding(x)  # (batch_size, input_seq_len, hid_dim)
-        emb *= tf.math.sqrt(tf.cast(self.hid_dim, tf.float32))
-        emb += self.pos_encoding[:, :seq_len, :]
+        emb *= tf.math.sqrt(tf.cast(self.hid_dim, emb.dtype))
+        tf.debugging.assert_less_equal(seq_len, self.maximum_position_encoding,
+                                       message='Encoder: input longer than maximum_position_encoding')
+        pos_encoding = sinusoid_position_table(self.maximum_position_encoding, self.hid_dim)
+        emb += tf.cast(pos_encoding[:, :seq_len, :], emb.dtype)
 
         output = self.dropout1(emb, training=training)
 
@@ -434,8 +1176,8 @@ class DecoderLayer(tf.keras.layers.Layer):
     def __init__(self, pf_dim, hid_dim, n_heads, dropout):
         super(DecoderLayer, self).__init__()
 
-        self.attn   = MultiHeadAttentionLayer(hid_dim, n_heads)
-        self.attn_2 = MultiHeadAttentionLayer(hid_dim, n_heads)
+        self.attn   = MultiHeadAttentionLayer(hid_dim, n_heads, fused='qkv' if USE_FUSED_QKV else None)
+        self.attn_2 = MultiHeadAttentionLayer(hid_dim, n_heads, fused='kv' if USE_FUSED_QKV else None)
 
         self.ffn = PositionwiseFeedforwardLayer(hid_dim, pf_dim)
 
@@ -448,16 +1190,22 @@ class DecoderLayer(tf.keras.layers.Layer):
         self.dropout3 = tf.keras.layers.Dropout(dropout)
 
     def call(self, inputs, enc_output, training,
-             look_ahead_mask, padding_mask):
+             look_ahead_mask, padding_mask, cache=None, decode_step=None, return_attention=True):
         # enc_output.shape == (batch_size, input_seq_len, hid_dim)
+        self_cache  = None if cache is None else cache['self']
+        cross_cache = None if cache is None else cache['cross']
 
         attention1, attn_weights_block1 = self.attn(
-            inputs, inputs, inputs, look_ahead_mask)  # (batch_size, target_seq_len, hid_dim)
+            inputs, inputs, inputs, look_ahead_mask,
+            cache=self_cache, decode_step=decode_step,
+            return_weights=return_attention)  # (batch_size, target_seq_len, hid_dim)
         attention1 = self.dropout1(attention1, training=training)
         attention1 = self.layernorm1(inputs + attention1)
 
         attention2, attn_weights_block2 = self.attn_2(
-            enc_output, enc_output, attention1, padding_mask)  # (batch_size, target_seq_len, hid_dim)
+            enc_output, enc_output, attention1, padding_mask,
+            cache=cross_cache, static_kv=True,
+            return_weights=return_attention)  # (batch_size, target_seq_len, hid_dim)
         attention2 = self.dropout2(attention2, training=training)
         attention2 = self.layernorm2(attention1 + attention2)  # (batch_size, target_seq_len, hid_dim)
 
@@ -477,40 +1225,82 @@ class Decoder(tf.keras.layers.Layer):
         self.n_layers = n_layers
 
         self.embedding = tf.keras.layers.Embedding(n_dec_vocab, hid_dim)
-        self.pos_encoding = get_sinusoid_encoding_table(maximum_position_encoding, hid_dim)
+        # 위치 표는 모든 encoder/decoder 가 함께 쓰는 표를 call 에서 가져온다.
+        # train_step 은 (None, None) shape 으로 트레이싱되어 입력 길이를 알 수 없으므로 표의 길이는 고정된 최대값이며,
+        # 디코딩 출력(MAX_MASK_LEN) 보다 짧지 않게 잡는다. 이보다 긴 입력은 call 에서 실패시킨다.
+        self.maximum_position_encoding = max(maximum_position_encoding, MAX_MASK_LEN)
 
         self.dec_layers = [DecoderLayer(pf_dim, hid_dim, n_heads, dropout)
                            for _ in range(n_layers)]
         self.dropout = tf.keras.layers.Dropout(dropout)
 
+    def init_cache(self, enc_output, max_len=0):
+        """Build the per-layer key/value cache used for incremental decoding.
+        셀프 어텐션의 key, value는 길이 max_len의 0 텐서로 시작하고 (0이면 매 시점 이어 붙임),
+        디코더-인코더 어텐션의 key, value는 인코더 출력으로부터 한 번만 계산한다.
+        """
+        batch_size = tf.shape(enc_output)[0]
+        cache = {}
+
+        for i in range(self.n_layers):
+            attn, attn_2 = self.dec_layers[i].attn, self.dec_layers[i].attn_2
+            enc_key, enc_value = attn_2.project_kv(enc_output, enc_output)
+
+            cache['decoder_layer{}'.format(i+1)] = {
+                'self': {
+                    'key':   tf.zeros((batch_size, attn.n_heads, max_len, attn.depth), dtype=enc_key.dtype),
+                    'value': tf.zeros((batch_size, attn.n_heads, max_len, attn.depth), dtype=enc_key.dtype),
+                },
+                'cross': {'key': enc_key, 'value': enc_value},
+            }
+
+        return cache
+
     def call(self, dec_input, enc_output, training,
-             look_ahead_mask, padding_mask):
+             look_ahead_mask, padding_mask, cache=None, decode_step=None, return_attention=True):
+        # return_attention=False 이면 (학습, 배치 추론) attention weights 를 만들지도 모으지도 않고 빈 dict 를 반환한다.
 
         seq_len = tf.shape(dec_input)[1]
         attention_weights = {}
 
+        # 캐시를 사용할 경우 dec_input은 새 토큰뿐이므로, 이미 처리한 길이만큼 위치를 이동한다.
+        if decode_step is not None:
+            start = decode_step
+        elif cache is not None:
+            start = tf.shape(cache['decoder_layer1']['self']['key'])[2]
+        else:
+            start = 0
+
         emb = self.embedding(dec_input)
-        emb *= tf.math.sqrt(tf.cast(self.hid_dim, tf.float32))
-        emb += self.pos_encoding[:, :seq_len, :]
+        emb *= tf.math.sqrt(tf.cast(self.hid_dim, emb.dtype))
+        tf.debugging.assert_less_equal(start + seq_len, self.maximum_position_encoding,
+                                       message='Decoder: input longer than maximum_position_encoding')
+        pos_encoding = sinusoid_position_table(self.maximum_position_encoding, self.hid_dim)
+        emb += tf.cast(pos_encoding[:, start:start + seq_len, :], emb.dtype)
 
         output = self.dropout(emb, training=training)
 
         for i in range(self.n_layers):
+            layer_cache = None if cache is None else cache['decoder_layer{}'.format(i+1)]
             output, block1, block2 = self.dec_layers[i](output, enc_output, training,
-                                                   look_ahead_mask, padding_mask)
+                                                   look_ahead_mask, padding_mask,
+                                                   cache=layer_cache, decode_step=decode_step,
+                                                   return_attention=return_attention)
 
-            attention_weights['decoder_layer{}_block1'.format(i+1)] = block1
-            attention_weights['decoder_layer{}_block2'.format(i+1)] = block2
+            if return_attention:
+                attention_weights['decoder_layer{}_block1'.format(i+1)] = block1
+                attention_weights['decoder_layer{}_block2'.format(i+1)] = block2
     
         return output, attention_weights
     
-def create_masks(inp, tar):
-    enc_padding_mask = create_padding_mask(inp)
-    dec_padding_mask = create_padding_mask(inp)
+def create_masks(inp, tar, inp_lengths=None, tar_lengths=None):
+    # 디코더의 두 번째 어텐션 블록도 인코더 패딩 마스크를 그대로 쓴다.
+    enc_padding_mask = create_padding_mask(inp, inp_lengths)
+    dec_padding_mask = enc_padding_mask
 
     look_ahead_mask = create_look_ahead_mask(tf.shape(tar)[1])
-    dec_target_padding_mask = create_padding_mask(tar)
-    look_ahead_mask = tf.maximum(dec_target_padding_mask, look_ahead_mask)
+    dec_target_padding_mask = create_padding_mask(tar, tar_lengths)
+    look_ahead_mask = tf.logical_or(dec_target_padding_mask, look_ahead_mask)
   
     return enc_padding_mask, look_ahead_mask, dec_padding_mask
 
@@ -530,13 +1320,28 @@ class Transformer(tf.keras.Model):
                                n_layers, pf_dim, hid_dim, n_heads,
                                pe_target, dropout)
 
-        self.fin_output = tf.keras.layers.Dense(n_dec_vocab)
+        self.fin_output = tf.keras.layers.Dense(n_dec_vocab, dtype='float32')  # mixed precision 에서도 logits 는 float32
     
-    def call(self, inp, tar, training, enc_padding_mask, look_ahead_mask, dec_padding_mask):
+    def call(self, inp, tar, training, enc_padding_mask, look_ahead_mask, dec_padding_mask,
+             return_attention=True):
         enc_output = self.encoder(inp, training, enc_padding_mask)
 
         dec_output, attention_weights = self.decoder(
-            tar, enc_output, training, look_ahead_mask, dec_padding_mask)
+            tar, enc_output, training, look_ahead_mask, dec_padding_mask,
+            return_attention=return_attention)
+
+        final_output = self.fin_output(dec_output)
+
+        return final_output, attention_weights
+
+    def encode(self, inp, training, enc_padding_mask):
+        return self.encoder(inp, training, enc_padding_mask)
+
+    def decode(self, tar, enc_output, training, look_ahead_mask, dec_padding_mask,
+               cache=None, decode_step=None, return_attention=True):
+        dec_output, attention_weights = self.decoder(
+            tar, enc_output, training, look_ahead_mask, dec_padding_mask,
+            cache=cache, decode_step=decode_step, return_attention=return_attention)
 
         final_output = self.fin_output(dec_output)
 
@@ -545,14 +1350,19 @@ class Transformer(tf.keras.Model):
 loss_object = tf.keras.losses.SparseCategoricalCrossentropy(
     from_logits=True, reduction='none')
 
-def loss_function(real, pred):
+def masked_loss(real, pred):
+    """Return the summed loss over non-pad tokens and the number of those tokens."""
     mask = tf.math.logical_not(tf.math.equal(real, 0))
     loss_ = loss_object(real, pred)
 
     mask = tf.cast(mask, dtype=loss_.dtype)
     loss_ *= mask
 
-    return tf.reduce_sum(loss_)/tf.reduce_sum(mask)
+    return tf.reduce_sum(loss_), tf.reduce_sum(mask)
+
+def loss_function(real, pred):
+    loss_sum, n_tokens = masked_loss(real, pred)
+    return loss_sum / n_tokens
 
 class CustomSchedule(tf.keras.optimizers.schedules.LearningRateSchedule):
     def __init__(self, hid_dim, warmup_steps=4000):
@@ -569,8 +1379,15 @@ class CustomSchedule(tf.keras.optimizers.schedules.LearningRateSchedule):
 
 learning_rate = CustomSchedule(hid_dim)
 
-optimizer = tf.keras.optimizers.Adam(learning_rate, beta_1=0.9, beta_2=0.98,
-                                     epsilon=1e-9)
+# optimizer, metric, model 의 변수는 strategy scope 안에서 만들어야 worker 사이에 동기화된다.
+with strategy.scope():
+    optimizer = tf.keras.optimizers.Adam(learning_rate, beta_1=0.9, beta_2=0.98,
+                                         epsilon=1e-9)
+
+    # float16 은 gradient underflow 를 막기 위해 loss scaling 이 필요하다. (bfloat16 은 float32 와 지수 범위가 같아서 불필요)
+    USE_LOSS_SCALING = MIXED_PRECISION == 'mixed_float16'
+    if USE_LOSS_SCALING:
+        optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
 
 temp_learning_rate_schedule = CustomSchedule(hid_dim)
 
@@ -586,75 +1403,193 @@ def accuracy_function(real, pred):
     mask = tf.cast(mask, dtype=tf.float32)
     return tf.reduce_sum(accuracies)/tf.reduce_sum(mask)
 
-train_loss = tf.keras.metrics.Mean(name='train_loss')
-train_accuracy = tf.keras.metrics.Mean(name='train_accuracy')
+# replica 마다 갱신한 metric 은 result() 에서 모든 replica 에 대해 합산된다.
+with strategy.scope():
+    train_loss = tf.keras.metrics.Mean(name='train_loss')
+    train_accuracy = tf.keras.metrics.Mean(name='train_accuracy')
+    # 처리량(tokens/sec) 계산용 : loss 에 들어간 (패딩이 아닌) target 토큰 수
+    train_tokens = tf.keras.metrics.Sum(name='train_tokens')
+
+""" multi-worker launcher """
+def local_tf_config(n_workers, index, base_port=23456):
+    """TF_CONFIG of worker `index` in a simulated cluster of n_workers processes on localhost."""
+    return json.dumps({
+        'cluster': {'worker': ['localhost:{}'.format(base_port + i) for i in range(n_workers)]},
+        'task': {'type': 'worker', 'index': index}})
+
+def launch_local_workers(n_workers):
+    """Run this script as n_workers MultiWorkerMirroredStrategy workers and wait for all of them."""
+    procs = [subprocess.Popen([sys.executable, os.path.abspath(sys.argv[0])],
+                              env=dict(os.environ, TF_CONFIG=local_tf_config(n_workers, index)))
+             for index in range(n_workers)]
+    return_codes = [proc.wait() for proc in procs]
+    if any(return_codes):
+        raise RuntimeError('multi-worker training failed : {}'.format(return_codes))
+
+# multi-worker 모드는 gradient accumulation, XLA 와 함께 쓰지 않는다.
+assert not (USE_MULTI_WORKER and (ACCUM_STEPS > 1 or USE_XLA))
+
+# launcher 는 tokenizer 와 token cache 를 먼저 만든 뒤 학습을 worker 들에게 맡기고,
+# 학습이 끝나면 chief(worker 0)의 checkpoint 를 복원해서 평가만 한다.
+if N_LOCAL_WORKERS and not USE_MULTI_WORKER:
+    launch_local_workers(N_LOCAL_WORKERS)
+    N_EPOCHS = 0
 
 """## Training and checkpointing"""
 
-model = Transformer(
-    n_enc_vocab = n_enc_vocab,
-    n_dec_vocab = n_dec_vocab,
-    n_layers  = n_layers,
-    pf_dim      = pf_dim,
-    hid_dim     = hid_dim,
-    n_heads     = n_heads,
-    pe_input    = 512,
-    pe_target   = 512,
-    dropout     = dropout)
+with strategy.scope():
+    model = Transformer(
+        n_enc_vocab = n_enc_vocab,
+        n_dec_vocab = n_dec_vocab,
+        n_layers  = n_layers,
+        pf_dim      = pf_dim,
+        hid_dim     = hid_dim,
+        n_heads     = n_heads,
+        pe_input    = 512,
+        pe_target   = 512,
+        dropout     = dropout)
 
 
 checkpoint_path = "./checkpoints"
 
 ckpt = tf.train.Checkpoint(model=model, optimizer=optimizer)
 
-ckpt_manager = tf.train.CheckpointManager(ckpt, checkpoint_path, max_to_keep=5)
+# save 는 모든 worker 가 호출해야 하지만 checkpoint_path 에는 chief(worker 0)만 저장하고,
+# 나머지는 task 마다 정해진 임시 디렉토리에 저장했다가 저장이 끝나면 지운다.
+ckpt_dir = checkpoint_path if TASK_INDEX == 0 else os.path.join(tempfile.gettempdir(), 'worker_ckpt_{}'.format(TASK_INDEX))
+ckpt_manager = tf.train.CheckpointManager(ckpt, ckpt_dir, max_to_keep=5)
 
 # if a checkpoint exists, restore the latest checkpoint.
-if ckpt_manager.latest_checkpoint:
-    ckpt.restore(ckpt_manager.latest_checkpoint)
+if tf.train.latest_checkpoint(checkpoint_path):
+    ckpt.restore(tf.train.latest_checkpoint(checkpoint_path))
     print('Latest checkpoint restored!!')
 
+""" gradient accumulation """
+# micro-batch 의 gradient 를 non-trainable 변수에 누적했다가 ACCUM_STEPS 번마다 한 번에 적용한다.
+# 누적하는 것은 토큰 단위 loss 합의 gradient 이고, 적용할 때 누적된 전체 토큰 수로 나누므로
+# micro-batch 마다 토큰 수가 달라도 큰 배치 하나로 학습한 것과 같은 token 가중 평균이 된다.
+# CustomSchedule 은 optimizer.iterations 기준이므로 warmup 도 큰 배치 학습과 같은 optimizer step 수로 진행된다.
+# loss 합에 fp16 loss scale 을 그대로 곱하면 overflow 하므로, 고정된 step 당 토큰 수 상한으로 나눈 뒤 scaling 하고
+# 적용할 때 그만큼 되돌린다. (상수이므로 micro-batch 사이의 token 가중치는 그대로다)
+ACCUM_TOKEN_SCALE = float(BATCH_SIZE * DECODER_LEN)
+accum_gradients = []
+accum_tokens = tf.Variable(0., trainable=False, name='accum_tokens')
+
+def accumulate_gradients(gradients, n_tokens):
+    # 누적 변수는 첫 트레이싱에서 한 번만 만든다.
+    if not accum_gradients:
+        accum_gradients.extend(tf.Variable(tf.zeros(var.shape, var.dtype), trainable=False)
+                               for var in model.trainable_variables)
+    for accum, grad in zip(accum_gradients, gradients):
+        if grad is not None:
+            accum.assign_add(tf.convert_to_tensor(grad))
+    accum_tokens.assign_add(n_tokens)
+
 @tf.function
-def train_step(inp, tar):
+def apply_accumulated_gradients():
+    gradients = [accum * (ACCUM_TOKEN_SCALE / accum_tokens) for accum in accum_gradients]
+    optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+
+    for accum in accum_gradients:
+        accum.assign(tf.zeros_like(accum))
+    accum_tokens.assign(0.)
+
+# 배치마다 길이가 달라도 다시 트레이싱하지 않도록 입력 shape을 (None, None)으로 고정
+train_step_signature = [
+    tf.TensorSpec(shape=(None, None), dtype=tf.int64),
+    tf.TensorSpec(shape=(None, None), dtype=tf.int64),
+    tf.TensorSpec(shape=(None,), dtype=tf.int32),
+    tf.TensorSpec(shape=(None,), dtype=tf.int32),
+]
+
+# XLA 사용 시에는 버킷 shape 별로 트레이싱하여 모든 shape 이 정적인 그래프를 컴파일한다. (컴파일 결과는 shape 별로 캐시된다)
+@tf.function(input_signature=None if USE_XLA else train_step_signature, jit_compile=USE_XLA)
+def train_step(inp, tar, inp_lengths, tar_lengths):
     tar_inp = tar[:, :-1]
     tar_real = tar[:, 1:]
 
-    enc_padding_mask, combined_mask, dec_padding_mask = create_masks(inp, tar_inp)
+    # tar_lengths 는 마지막 열을 뺀 tar_inp 의 폭보다 클 수 있지만 sequence_mask 가 폭에 맞춰 준다.
+    enc_padding_mask, combined_mask, dec_padding_mask = create_masks(inp, tar_inp, inp_lengths, tar_lengths)
 
     with tf.GradientTape() as tape:
         predictions, _ = model(inp, tar_inp, 
             True, 
             enc_padding_mask, 
             combined_mask, 
-            dec_padding_mask
+            dec_padding_mask,
+            return_attention=False
         )
-        loss = loss_function(tar_real, predictions)
-
-    gradients = tape.gradient(loss, model.trainable_variables)
-    optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+        loss_sum, n_tokens = masked_loss(tar_real, predictions)
+        loss = loss_sum / n_tokens
+        # replica 들의 gradient 는 합산되므로 모든 replica 의 토큰 수로 나눈다. (replica 가 하나면 loss 와 같다)
+        global_tokens = tf.distribute.get_replica_context().all_reduce(tf.distribute.ReduceOp.SUM, n_tokens)
+        # accumulation 시에는 (loss 합 / ACCUM_TOKEN_SCALE) 의 gradient 를 누적하고, 적용할 때 전체 토큰 수로 나눈다.
+        objective = loss_sum / ACCUM_TOKEN_SCALE if ACCUM_STEPS > 1 else loss_sum / global_tokens
+        scaled_loss = optimizer.get_scaled_loss(objective) if USE_LOSS_SCALING else objective
+
+    gradients = tape.gradient(scaled_loss, model.trainable_variables)
+    if USE_LOSS_SCALING:
+        gradients = optimizer.get_unscaled_gradients(gradients)
+    if ACCUM_STEPS > 1:
+        accumulate_gradients(gradients, n_tokens)
+    else:
+        optimizer.apply_gradients(zip(gradients, model.trainable_variables))
 
     train_loss(loss)
     train_accuracy(accuracy_function(tar_real, predictions))
+    train_tokens(n_tokens)
+
+# worker 마다 make_dataset(input_context) 로 자기 몫의 행만 읽는 pipeline 을 만든다.
+if USE_MULTI_WORKER:
+    dist_dataset = strategy.distribute_datasets_from_function(make_dataset)
+
+    @tf.function(experimental_relax_shapes=True)
+    def distributed_train_step(*batch):
+        strategy.run(train_step, args=batch)
+else:
+    dist_dataset = dataset
+    distributed_train_step = train_step
 
 for epoch in range(N_EPOCHS):
     train_loss.reset_states()
+    train_tokens.reset_states()
+    start = time.time()
     
-    with tqdm_notebook(total=len(dataset), desc=f"Train {epoch+1}") as pbar:
-        for (batch, (inp, tar)) in enumerate(dataset):
-            train_step(inp, tar)
+    # dataset 이 비어 있어도 epoch 끝의 계산이 동작하도록 step 수를 루프 밖에서 센다.
+    n_steps = 0
+    with tqdm_notebook(total=N_BATCHES, desc=f"Train {epoch+1}") as pbar:
+        for (inp, tar, inp_lengths, tar_lengths) in dist_dataset:
+            distributed_train_step(inp, tar, inp_lengths, tar_lengths)
+            n_steps += 1
+            if ACCUM_STEPS > 1 and n_steps % ACCUM_STEPS == 0:
+                apply_accumulated_gradients()
     
             pbar.update(1)
-            pbar.set_postfix_str(f"Loss {train_loss.result():.4f} Accuracy {train_accuracy.result():.4f}")
+            pbar.set_postfix_str(f"Loss {train_loss.result():.4f} Accuracy {train_accuracy.result():.4f} "
+                                 f"Tokens/sec {train_tokens.result() / (time.time() - start):.0f}")
+
+        # epoch 마지막에 남은 micro-batch 의 gradient 도 적용한다.
+        if ACCUM_STEPS > 1 and n_steps % ACCUM_STEPS:
+            apply_accumulated_gradients()
             
     # print(f'Epoch {epoch + 1} Loss {train_loss.result():.4f} Accuracy {train_accuracy.result():.4f}')
+    elapsed = time.time() - start
+    print(f'Epoch {epoch + 1} {train_tokens.result() / elapsed:.0f} tokens/sec, Step time {elapsed / max(n_steps, 1):.4f} sec')
     
-ckpt_save_path = ckpt_manager.save()
-print ('Saving checkpoint for epoch {} at {}'.format(epoch+1, ckpt_save_path))
+if N_EPOCHS:
+    ckpt_save_path = ckpt_manager.save()
+    print ('Saving checkpoint for epoch {} at {}'.format(epoch+1, ckpt_save_path))
+    if TASK_INDEX != 0:
+        shutil.rmtree(ckpt_dir, ignore_errors=True)
+
+# worker 는 학습과 저장까지만 한다. 평가는 launcher 가 chief 의 checkpoint 로 실행한다.
+if USE_MULTI_WORKER:
+    sys.exit(0)
 
 raw_src = raw_src.tolist()
 raw_trg = raw_trg.tolist()
 
-def evaluate(text):
+def evaluate(text, use_cache=True):
     text = SRC_tokenizer.texts_to_sequences([text])
     text = tf.keras.preprocessing.sequence.pad_sequences(text, maxlen=ENCODER_LEN,
                                                          padding='post', truncating='post')
@@ -664,18 +1599,36 @@ def evaluate(text):
     decoder_input = [TRG_tokenizer.word_index['<sos>']]
     output = tf.expand_dims(decoder_input, 0)
 
+    if use_cache:
+        # 인코더는 한 번만 실행하고, 디코더는 매 시점 새 토큰만 처리한다.
+        enc_padding_mask = create_padding_mask(encoder_input)
+        enc_output = model.encode(encoder_input, False, enc_padding_mask)
+        cache = model.decoder.init_cache(enc_output)
+
     # 디코더의 예측 시작
     for i in range(DECODER_LEN):
-        enc_padding_mask, combined_mask, dec_padding_mask = create_masks(encoder_input, output)
-
-        predictions, attention_weights = model(
-            encoder_input, 
-            output,
-            False,
-            enc_padding_mask,
-            combined_mask,
-            dec_padding_mask
-        )
+        if use_cache:
+            # 새 토큰은 이전 토큰을 모두 볼 수 있으므로 룩어헤드 마스크의 마지막 행 = 패딩 마스크
+            # 출력에는 패딩이 없으므로 길이는 output 의 길이이다.
+            predictions, attention_weights = model.decode(
+                output[:, -1:],
+                enc_output,
+                False,
+                create_padding_mask(output, [i + 1]),
+                enc_padding_mask,
+                cache=cache
+            )
+        else:
+            enc_padding_mask, combined_mask, dec_padding_mask = create_masks(encoder_input, output)
+
+            predictions, attention_weights = model(
+                encoder_input, 
+                output,
+                False,
+                enc_padding_mask,
+                combined_mask,
+                dec_padding_mask
+            )
 
         # 현재(마지막) 시점의 예측 단어를 받아온다.
         predictions = predictions[:, -1:, :]
@@ -690,15 +1643,626 @@ def evaluate(text):
 
     return tf.squeeze(output, axis=0), attention_weights
 
+def evaluate_batch(encoder_input):
+    """Greedy-decode a padded (batch_size, src_len) batch of source ids.
+    종료 토큰을 출력한 문장(finished)은 배치에서 제외하여 더 이상 계산하지 않는다.
+    Returns the output ids of each sentence (시작 토큰 포함, 종료 토큰 제외) in input order.
+    """
+    encoder_input = tf.convert_to_tensor(encoder_input)
+    batch_size = encoder_input.shape[0]
+
+    enc_padding_mask = create_padding_mask(encoder_input)
+    enc_output = model.encode(encoder_input, False, enc_padding_mask)
+    cache = model.decoder.init_cache(enc_output)
+
+    output = tf.fill([batch_size, 1], TRG_tokenizer.word_index['<sos>'])
+    # 아직 번역 중인 문장들의 원래 배치 내 위치
+    active = np.arange(batch_size)
+    results = [None] * batch_size
+
+    # 디코더의 예측 시작
+    for i in range(DECODER_LEN):
+        predictions, _ = model.decode(
+            output[:, -1:],
+            enc_output,
+            False,
+            create_padding_mask(output, tf.fill([len(active)], i + 1)),
+            enc_padding_mask,
+            cache=cache,
+            return_attention=False
+        )
+
+        predicted_id = tf.cast(tf.argmax(predictions[:, -1, :], axis=-1), tf.int32)
+        finished = tf.equal(predicted_id, TRG_tokenizer.word_index['<eos>']).numpy()
+
+        output = tf.concat([output, predicted_id[:, tf.newaxis]], axis=-1)
+
+        if finished.any():
+            for row in np.flatnonzero(finished):
+                results[active[row]] = output[row, :-1].numpy()
+
+            # 종료된 문장은 배치에서 제외
+            keep = np.flatnonzero(~finished)
+            if len(keep) == 0:
+                return results
+
+            active = active[keep]
+            output = tf.gather(output, keep)
+            enc_output = tf.gather(enc_output, keep)
+            enc_padding_mask = tf.gather(enc_padding_mask, keep)
+            cache = tf.nest.map_structure(lambda t: tf.gather(t, keep), cache)
+
+    for row, idx in enumerate(active):
+        results[idx] = output[row].numpy()
+
+    return results
+
+""" beam search """
+@tf.function(experimental_relax_shapes=True)
+def beam_search(encoder_input, beam_size=4, alpha=0.6):
+    """Beam search over a padded (batch_size, src_len) batch of source ids.
+    빔 상태는 (batch_size * beam_size, 길이) 텐서로 관리하고,
+    모든 빔이 종료 토큰을 출력하면 조기 종료한다.
+    디코더에는 매 시점 새 토큰 하나만 넣고, 셀프 어텐션 key/value 캐시는 선택된 빔 순서로 다시 모은다.
+    최종 후보는 GNMT 길이 정규화 ((5 + 길이) / 6) ** alpha 로 나눈 점수로 고른다.
+
+    Returns:
+        (batch_size, out_len) 최적 시퀀스. 시작 토큰 포함, 종료 토큰부터는 0으로 채운다.
+    """
+    batch_size = tf.shape(encoder_input)[0]
+
+    # 인코더는 문장마다 한 번만 실행하고 출력을 beam_size번 반복한다 : (batch_size * beam_size, src_len, hid_dim)
+    enc_padding_mask = create_padding_mask(encoder_input)
+    enc_output = model.encode(encoder_input, False, enc_padding_mask)
+    enc_output = tf.repeat(enc_output, beam_size, axis=0)
+    enc_padding_mask = tf.repeat(enc_padding_mask, beam_size, axis=0)
+    # 셀프 어텐션 캐시는 DECODER_LEN 크기로 미리 할당해 루프 안에서 shape이 변하지 않는다.
+    cache = model.decoder.init_cache(enc_output, max_len=DECODER_LEN)
+
+    seqs = tf.fill([batch_size * beam_size, 1], TRG_tokenizer.word_index['<sos>'])
+    # 첫 시점에 같은 후보가 여러 번 선택되지 않도록 첫 번째 빔만 살려 둔다.
+    log_probs = tf.tile([[0.] + [-1e9] * (beam_size - 1)], [batch_size, 1])
+    lengths = tf.zeros([batch_size, beam_size])
+    finished = tf.zeros([batch_size, beam_size], dtype=tf.bool)
+
+    for i in tf.range(DECODER_LEN):
+        tf.autograph.experimental.set_loop_options(
+            shape_invariants=[(seqs, tf.TensorShape([None, None]))])
+
+        # 아직 기록되지 않은 캐시 위치(i 이후)를 가리는 마스크가 곧 룩어헤드 마스크가 된다.
+        step_mask = tf.logical_not(tf.sequence_mask(i + 1, DECODER_LEN))
+        predictions, _ = model.decode(seqs[:, -1:], enc_output, False, step_mask, enc_padding_mask,
+                                      cache=cache, decode_step=i, return_attention=False)
+
+        step_log_probs = tf.nn.log_softmax(predictions[:, -1, :], axis=-1)
+        n_vocab = tf.shape(step_log_probs)[-1]
+
+        # 종료된 빔은 점수 변화 없이 패딩(0)만 이어 붙일 수 있다.
+        pad_only = tf.one_hot(0, n_vocab, on_value=0., off_value=-1e9)
+        step_log_probs = tf.where(tf.reshape(finished, [-1, 1]), pad_only, step_log_probs)
+
+        # 문장마다 (beam_size * n_vocab)개의 후보 중 상위 beam_size개를 선택
+        scores = log_probs[:, :, tf.newaxis] + tf.reshape(step_log_probs, [batch_size, beam_size, -1])
+        log_probs, top_idx = tf.math.top_k(tf.reshape(scores, [batch_size, -1]), k=beam_size)
+        beam_idx = top_idx // n_vocab
+        token_id = top_idx % n_vocab
+
+        # 선택된 후보가 이어 붙을 이전 빔의 상태를 모아 온다.
+        gather_idx = tf.reshape(beam_idx + tf.range(batch_size)[:, tf.newaxis] * beam_size, [-1])
+        seqs = tf.concat([tf.gather(seqs, gather_idx), tf.reshape(token_id, [-1, 1])], axis=-1)
+        # 인코더 쪽 key, value 는 같은 문장의 빔끼리 같으므로 셀프 어텐션 캐시만 모은다.
+        cache = {name: {'self': tf.nest.map_structure(lambda t: tf.gather(t, gather_idx), layer_cache['self']),
+                        'cross': layer_cache['cross']}
+                 for name, layer_cache in cache.items()}
+
+        prev_finished = tf.reshape(tf.gather(tf.reshape(finished, [-1]), gather_idx), [batch_size, beam_size])
+        lengths = tf.reshape(tf.gather(tf.reshape(lengths, [-1]), gather_idx), [batch_size, beam_size])
+        lengths += tf.cast(tf.logical_not(prev_finished), tf.float32)
+        finished = tf.logical_or(prev_finished, tf.equal(token_id, TRG_tokenizer.word_index['<eos>']))
+
+        if tf.reduce_all(finished):
+            break
+
+    # 길이 정규화 점수가 가장 높은 빔을 선택
+    normalized = log_probs / tf.pow((5. + lengths) / 6., alpha)
+    best = tf.argmax(normalized, axis=-1, output_type=tf.int32) + tf.range(batch_size) * beam_size
+    best_seqs = tf.gather(seqs, best)
+
+    return tf.where(tf.equal(best_seqs, TRG_tokenizer.word_index['<eos>']), 0, best_seqs)
+
+""" graph-compiled greedy decoding """
+@tf.function(input_signature=[tf.TensorSpec(shape=[None, None], dtype=tf.int32)])
+def greedy_decode(encoder_input):
+    """Greedy-decode a padded (batch_size, src_len) batch inside a single tf.while_loop.
+    출력 버퍼 (batch_size, DECODER_LEN + 1)와 key/value 캐시를 미리 할당해 두고,
+    매 시점 decode_step 위치에만 기록하므로 루프 안에서 shape이 변하지 않는다.
+
+    Returns:
+        (batch_size, DECODER_LEN + 1) 출력. 시작 토큰 포함, 종료 토큰부터는 0으로 채운다.
+    """
+    batch_size = tf.shape(encoder_input)[0]
+
+    enc_padding_mask = create_padding_mask(encoder_input)
+    enc_output = model.encode(encoder_input, False, enc_padding_mask)
+    cache = model.decoder.init_cache(enc_output, max_len=DECODER_LEN)
+
+    output = tf.pad(tf.fill([batch_size, 1], TRG_tokenizer.word_index['<sos>']), [[0, 0], [0, DECODER_LEN]])
+    finished = tf.zeros([batch_size], dtype=tf.bool)
+
+    def cond(i, output, finished, cache):
+        return tf.logical_and(i < DECODER_LEN, tf.logical_not(tf.reduce_all(finished)))
+
+    def body(i, output, finished, cache):
+        # 아직 기록되지 않은 위치(i 이후)를 가리는 패딩 마스크가 곧 룩어헤드 마스크가 된다.
+        predictions, _ = model.decode(
+            output[:, i:i + 1],
+            enc_output,
+            False,
+            create_padding_mask(output[:, :DECODER_LEN], tf.fill([batch_size], i + 1)),
+            enc_padding_mask,
+            cache=cache,
+            decode_step=i,
+            return_attention=False
+        )
+
+        predicted_id = tf.cast(tf.argmax(predictions[:, -1, :], axis=-1), tf.int32)
+        finished = tf.logical_or(finished, tf.equal(predicted_id, TRG_tokenizer.word_index['<eos>']))
+        predicted_id = tf.where(finished, 0, predicted_id)
+
+        output += predicted_id[:, tf.newaxis] * tf.one_hot(i + 1, DECODER_LEN + 1, dtype=tf.int32)
+
+        return i + 1, output, finished, cache
+
+    _, output, _, _ = tf.while_loop(cond, body, [tf.constant(0), output, finished, cache])
+
+    return output
+
+""" detokenize """
+# 번역 결과의 id 행렬을 한 번에 문장으로 바꾼다. id -> 단어 표와 특수 토큰 id 는 한 번만 만들어 둔다.
+TRG_words       = np.array([''] + [TRG_tokenizer.index_word[i] for i in range(1, len(TRG_tokenizer.index_word) + 1)],
+                           dtype=object)
+TRG_special_ids = np.array(list(special_tokens['TRG'].values()))
+
+def detokenize(predictions):
+    """Convert a (batch_size, len) id matrix into a list of sentences.
+    종료 토큰부터 뒤는 잘라내고, 특수 토큰과 패딩(0)은 vectorized 연산으로 한 번에 지운다.
+    """
+    predictions = np.asarray(predictions)
+    before_end  = np.cumsum(predictions == TRG_tokenizer.word_index['<eos>'], axis=1) == 0
+    keep  = before_end & (predictions != 0) & ~np.isin(predictions, TRG_special_ids)
+    words = TRG_words[predictions]
+    return [' '.join(row[row_keep]) for row, row_keep in zip(words, keep)]
+
+def translate_batch(sentences, batch_size=64, beam_size=1, alpha=0.6):
+    """Translate a list of sentences, batch_size sentences at a time.
+    길이가 비슷한 문장끼리 묶어 패딩을 줄이고, 번역 결과는 입력 순서대로 반환한다.
+    beam_size > 1 이면 그리디 디코딩 대신 빔 서치를 사용한다.
+    """
+    tokenized = [seq[:ENCODER_LEN] for seq in SRC_tokenizer.texts_to_sequences(sentences)]
+    order = np.argsort([len(seq) for seq in tokenized], kind='stable')
+    translations = [None] * len(sentences)
+
+    for start in range(0, len(order), batch_size):
+        batch_idx = order[start:start + batch_size]
+        encoder_input = tf.keras.preprocessing.sequence.pad_sequences(
+            [tokenized[idx] for idx in batch_idx], padding='post')
+
+        if beam_size > 1:
+            predictions = beam_search(encoder_input, beam_size, alpha).numpy()
+        else:
+            # 문장마다 길이가 다르므로 뒤를 0 으로 채워 (batch_size, len) 행렬로 만든다.
+            predictions = tf.keras.preprocessing.sequence.pad_sequences(evaluate_batch(encoder_input), padding='post')
+
+        for idx, translation in zip(batch_idx, detokenize(predictions)):
+            translations[idx] = translation
+
+    return translations
+
 def predict(text):
-    prediction = evaluate(text=text)[0].numpy()
-    prediction = np.expand_dims(prediction[1:], 0)  
-    predicted_sentence = TRG_tokenizer.sequences_to_texts(prediction)[0]
-    
-    return predicted_sentence
+    return translate_batch([text])[0]
 
 for idx in (11, 21, 31, 41, 51):
     print("Input        :", raw_src[idx])
     print("Prediction   :", predict(raw_src[idx]))
     print("Ground Truth :", raw_trg[idx],"\n")
+
+# 여러 문장을 배치 단위로 한 번에 번역
+if RUN_BENCHMARKS:
+    sentences = list(raw_src[:1024])
+
+    start = time.time()
+    translations = translate_batch(sentences, batch_size=64)
+    print('translate_batch : {:.1f} sentences/sec'.format(len(sentences) / (time.time() - start)))
+
+# 그리디 디코딩(beam_size=1)과 빔 서치의 속도 비교
+if RUN_BENCHMARKS:
+    for beam_size in (1, 4):
+        start = time.time()
+        translations = translate_batch(sentences, batch_size=64, beam_size=beam_size)
+        n_tokens = sum(len(translation.split()) for translation in translations)
+        print('beam_size {} : {:.1f} tokens/sec'.format(beam_size, n_tokens / (time.time() - start)))
+
+# KV 캐시 디코딩과 기존(매 시점 전체 재계산) 디코딩의 문장당 시간 비교
+# (작은 무작위 모델에서의 토큰 단위 일치는 tests/test_cached_decoding.py 에서 검사한다.)
+if RUN_BENCHMARKS:
+    start = time.time()
+    cached = [evaluate(raw_src[idx], use_cache=True)[0].numpy() for idx in range(11, 111)]
+    cached_time = time.time() - start
+
+    start = time.time()
+    uncached = [evaluate(raw_src[idx], use_cache=False)[0].numpy() for idx in range(11, 111)]
+    uncached_time = time.time() - start
+
+    for output_1, output_2 in zip(cached, uncached):
+        assert np.array_equal(output_1, output_2)
+
+    print('KV cache    : {:.4f} sec/sentence'.format(cached_time / len(cached)))
+    print('No cache    : {:.4f} sec/sentence'.format(uncached_time / len(uncached)))
+
+# tf.while_loop로 컴파일한 디코딩 루프와 즉시 실행(eager) evaluate()의 문장당 지연 시간 비교
+if RUN_BENCHMARKS:
+    encoder_inputs = [tf.keras.preprocessing.sequence.pad_sequences(SRC_tokenizer.texts_to_sequences([raw_src[idx]]),
+                                                                    maxlen=ENCODER_LEN, padding='post', truncating='post')
+                      for idx in range(11, 111)]
+    greedy_decode(encoder_inputs[0])  # input_signature 덕분에 트레이싱은 한 번만 일어난다.
+
+    start = time.time()
+    eager_outputs = [evaluate(raw_src[idx])[0].numpy() for idx in range(11, 111)]
+    eager_time = time.time() - start
+
+    start = time.time()
+    graph_outputs = [greedy_decode(encoder_input)[0].numpy() for encoder_input in encoder_inputs]
+    graph_time = time.time() - start
+
+    for output_1, output_2 in zip(eager_outputs, graph_outputs):
+        assert np.array_equal(output_1, output_2[output_2 != 0])
+
+    print('eager evaluate() : {:.4f} sec/sentence'.format(eager_time / len(eager_outputs)))
+    print('greedy_decode()  : {:.4f} sec/sentence'.format(graph_time / len(graph_outputs)))
     
+
+
+# 영어 정규화(normalize_en, normalize_en_tf)와 기존 re.sub 루프의 속도 비교.
+# 규칙 순서대로 적용한 결과와 같은지는 tests/test_normalize_en.py 가 corpus 없이 확인한다.
+if RUN_BENCHMARKS:
+    def normalize_en_loop(sentence):
+        sentence = sentence.lower().strip()
+        sentence = re.sub(r"([?.!,])", r" \1 ", sentence)
+        sentence = re.sub(r'[" "]+', " ", sentence)
+        for pattern, rewrite in EN_CONTRACTIONS:
+            sentence = re.sub(pattern, rewrite, sentence)
+        sentence = re.sub(r"[^a-zA-Z?.!,]+", " ", sentence)
+        return sentence.strip()
+
+    samples = list(total_df['SRC'].astype(str))
+
+    sentences = (samples * (1000000 // len(samples) + 1))[:1000000]
+
+    start = time.time()
+    outputs_loop = [normalize_en_loop(sentence) for sentence in sentences]
+    loop_time = time.time() - start
+
+    start = time.time()
+    outputs = [normalize_en(sentence) for sentence in sentences]
+    single_pass_time = time.time() - start
+    assert outputs == outputs_loop
+
+    start = time.time()
+    normalized = tf.data.Dataset.from_tensor_slices(sentences).batch(4096)
+    normalized = normalized.map(normalize_en_tf, num_parallel_calls=AUTO)
+    outputs_tf = [sentence.decode('utf-8') for batch in normalized.as_numpy_iterator() for sentence in batch]
+    tf_data_time = time.time() - start
+    assert outputs_tf == outputs_loop
+
+    print('re.sub loop        : {:.0f} sentences/sec'.format(len(sentences) / loop_time))
+    print('normalize_en       : {:.0f} sentences/sec'.format(len(sentences) / single_pass_time))
+    print('normalize_en_tf    : {:.0f} sentences/sec'.format(len(sentences) / tf_data_time))
+
+
+# float32 와 mixed precision 의 학습 step (forward + backward) 시간 비교. 같은 배치에 대해 새로 만든 모델로 측정
+if RUN_BENCHMARKS:
+    def benchmark_policy(policy, batch, n_steps=20):
+        tf.keras.mixed_precision.set_global_policy(policy)
+        bench_model = Transformer(
+            n_enc_vocab = n_enc_vocab,
+            n_dec_vocab = n_dec_vocab,
+            n_layers  = n_layers,
+            pf_dim      = pf_dim,
+            hid_dim     = hid_dim,
+            n_heads     = n_heads,
+            pe_input    = 512,
+            pe_target   = 512,
+            dropout     = dropout)
+
+        @tf.function
+        def bench_step(inp, tar, inp_lengths, tar_lengths):
+            tar_inp = tar[:, :-1]
+            tar_real = tar[:, 1:]
+            enc_padding_mask, combined_mask, dec_padding_mask = create_masks(inp, tar_inp, inp_lengths, tar_lengths)
+
+            with tf.GradientTape() as tape:
+                predictions, _ = bench_model(inp, tar_inp, True, enc_padding_mask, combined_mask, dec_padding_mask,
+                                             return_attention=False)
+                loss = loss_function(tar_real, predictions)
+            return tape.gradient(loss, bench_model.trainable_variables)
+
+        bench_step(*batch)
+        has_gpu = bool(tf.config.list_physical_devices('GPU'))
+        if has_gpu:
+            tf.config.experimental.reset_memory_stats('GPU:0')
+
+        start = time.time()
+        for _ in range(n_steps):
+            bench_step(*batch)
+        step_time = (time.time() - start) / n_steps
+
+        peak_memory = tf.config.experimental.get_memory_info('GPU:0')['peak'] / 2**20 if has_gpu else float('nan')
+        return step_time, peak_memory
+
+    bench_batch = next(iter(dataset))
+    bench_policy = MIXED_PRECISION or ('mixed_float16' if tf.config.list_physical_devices('GPU') else 'mixed_bfloat16')
+    for policy in ('float32', bench_policy):
+        step_time, peak_memory = benchmark_policy(policy, bench_batch)
+        print('{:15s} : {:.4f} sec/step, peak memory {:.0f} MB'.format(policy, step_time, peak_memory))
+    tf.keras.mixed_precision.set_global_policy(MIXED_PRECISION or 'float32')
+
+
+# XLA(jit_compile) 와 기존 tf.function 의 train_step 비교 (CPU). 버킷 shape 마다 첫 호출의 합을 컴파일 시간으로,
+# 모든 shape 이 컴파일된 뒤의 평균을 steady-state step 시간으로 본다.
+# 학습한 model 과 optimizer 를 바꾸지 않도록 측정마다 새로 만든 모델과 optimizer 를 사용한다.
+if RUN_BENCHMARKS:
+    def benchmark_train_step(jit_compile, batches, n_rounds=3):
+        bench_model = Transformer(
+            n_enc_vocab = n_enc_vocab,
+            n_dec_vocab = n_dec_vocab,
+            n_layers  = n_layers,
+            pf_dim      = pf_dim,
+            hid_dim     = hid_dim,
+            n_heads     = n_heads,
+            pe_input    = 512,
+            pe_target   = 512,
+            dropout     = dropout)
+        bench_optimizer = tf.keras.optimizers.Adam(CustomSchedule(hid_dim), beta_1=0.9, beta_2=0.98, epsilon=1e-9)
+
+        def bench_step(inp, tar, inp_lengths, tar_lengths):
+            tar_inp = tar[:, :-1]
+            tar_real = tar[:, 1:]
+            enc_padding_mask, combined_mask, dec_padding_mask = create_masks(inp, tar_inp, inp_lengths, tar_lengths)
+
+            with tf.GradientTape() as tape:
+                predictions, _ = bench_model(inp, tar_inp, True, enc_padding_mask, combined_mask, dec_padding_mask,
+                                             return_attention=False)
+                loss_sum, n_tokens = masked_loss(tar_real, predictions)
+                loss = loss_sum / n_tokens
+            gradients = tape.gradient(loss, bench_model.trainable_variables)
+            bench_optimizer.apply_gradients(zip(gradients, bench_model.trainable_variables))
+
+        step_fn = tf.function(bench_step,
+                              input_signature=None if jit_compile else train_step.input_signature,
+                              jit_compile=jit_compile)
+        with tf.device('/CPU:0'):
+            start = time.time()
+            for batch in batches:
+                step_fn(*batch)
+            compile_time = time.time() - start
+
+            start = time.time()
+            for _ in range(n_rounds):
+                for batch in batches:
+                    step_fn(*batch)
+            step_time = (time.time() - start) / (n_rounds * len(batches))
+        return compile_time, step_time
+
+    bench_batches = {}
+    for batch in dataset.take(50):
+        bench_batches.setdefault(tuple(batch[0].shape), batch)
+    bench_batches = list(bench_batches.values())
+
+    for jit_compile in (False, True):
+        compile_time, step_time = benchmark_train_step(jit_compile, bench_batches)
+        print('jit_compile={:5s} : compile {:.2f} sec ({} shapes), steady-state {:.4f} sec/step'.format(
+            str(jit_compile), compile_time, len(bench_batches), step_time))
+
+
+# fused QKV/KV 프로젝션과 기존 q, k, v 프로젝션의 MultiHeadAttentionLayer forward + backward 시간 비교.
+# (BATCH_SIZE, ENCODER_LEN, hid_dim) 입력에서 같은 weight 로 두 경로의 출력이 같은지도 확인한다.
+if RUN_BENCHMARKS:
+    def benchmark_attention(fused, inputs, source=None, n_steps=50):
+        layer = MultiHeadAttentionLayer(hid_dim, n_heads, fused=fused)
+        layer(*inputs, None)
+        if source is not None:
+            fuse_attention_weights(source, layer)
+
+        @tf.function
+        def step(value, key, query):
+            with tf.GradientTape() as tape:
+                tape.watch(query)
+                outputs, _ = layer(value, key, query, None)
+            return outputs, tape.gradient(outputs, [query] + layer.trainable_variables)
+
+        outputs, _ = step(*inputs)
+        start = time.time()
+        for _ in range(n_steps):
+            step(*inputs)
+        return layer, outputs, (time.time() - start) / n_steps
+
+    bench_x   = tf.random.uniform((BATCH_SIZE, ENCODER_LEN, hid_dim))
+    bench_enc = tf.random.uniform((BATCH_SIZE, ENCODER_LEN, hid_dim))
+    bench_cases = [('self-attention', 'qkv', (bench_x, bench_x, bench_x)),
+                   ('cross-attention', 'kv', (bench_enc, bench_enc, bench_x))]
+    for name, fused, inputs in bench_cases:
+        layer, outputs, step_time = benchmark_attention(None, inputs)
+        _, fused_outputs, fused_time = benchmark_attention(fused, inputs, layer)
+        np.testing.assert_allclose(outputs.numpy(), fused_outputs.numpy(), rtol=1e-2, atol=1e-2)
+        print('{:15s} : q/k/v {:.4f} sec/step, fused {:3s} {:.4f} sec/step'.format(name, step_time, fused, fused_time))
+
+
+# 기존 어텐션과 블록 단위 online softmax 어텐션(ATTENTION_CHUNK_SIZE)의 MultiHeadAttentionLayer forward + backward 비교.
+# ENCODER_LEN 을 4배로 늘린 입력에서 peak 메모리(GPU)와 시간을 재고, 같은 weight 로 출력과 gradient 가 같은지 확인한다.
+# 기존 어텐션은 (batch, heads, q, k) logits 를 모두 만들므로 OOM 이 나지 않도록 배치는 BATCH_SIZE 의 1/8 로 줄인다.
+if RUN_BENCHMARKS:
+    def benchmark_chunked_attention(chunk_size, layer, inputs, mask, d_outputs, n_steps=10):
+        global ATTENTION_CHUNK_SIZE
+        ATTENTION_CHUNK_SIZE = chunk_size
+
+        @tf.function
+        def step(inputs):
+            with tf.GradientTape() as tape:
+                tape.watch(inputs)
+                outputs, _ = layer(inputs, inputs, inputs, mask, return_weights=False)
+                loss = tf.reduce_sum(tf.cast(outputs, tf.float32) * d_outputs)
+            return outputs, tape.gradient(loss, [inputs] + layer.trainable_variables)
+
+        outputs, grads = step(inputs)
+        has_gpu = bool(tf.config.list_physical_devices('GPU'))
+        if has_gpu:
+            tf.config.experimental.reset_memory_stats('GPU:0')
+
+        start = time.time()
+        for _ in range(n_steps):
+            step(inputs)
+        step_time = (time.time() - start) / n_steps
+
+        peak_memory = tf.config.experimental.get_memory_info('GPU:0')['peak'] / 2**20 if has_gpu else float('nan')
+        return outputs, grads, step_time, peak_memory
+
+    chunk_size_setting = ATTENTION_CHUNK_SIZE
+    bench_len     = 4 * ENCODER_LEN
+    bench_rows    = max(1, BATCH_SIZE // 8)
+    bench_long    = tf.random.uniform((bench_rows, bench_len, hid_dim))
+    bench_lengths = tf.random.uniform((bench_rows,), 1, bench_len + 1, dtype=tf.int32)
+    bench_mask    = create_padding_mask(bench_long[..., 0], bench_lengths)
+    bench_dout    = tf.random.normal((bench_rows, bench_len, hid_dim))
+    bench_layer   = MultiHeadAttentionLayer(hid_dim, n_heads)
+
+    results = {}
+    try:
+        for chunk_size in (None, chunk_size_setting or 128):
+            outputs, grads, step_time, peak_memory = benchmark_chunked_attention(
+                chunk_size, bench_layer, bench_long, bench_mask, bench_dout)
+            results[chunk_size] = outputs, grads
+            print('chunk_size={} (batch {}, seq_len {}) : {:.4f} sec/step, peak memory {:.0f} MB'.format(
+                chunk_size, bench_rows, bench_len, step_time, peak_memory))
+    finally:
+        ATTENTION_CHUNK_SIZE = chunk_size_setting
+
+    (outputs, grads), (chunked_outputs, chunked_grads) = results.values()
+    np.testing.assert_allclose(outputs.numpy(), chunked_outputs.numpy(), rtol=1e-2, atol=1e-2)
+    for grad, chunked_grad in zip(grads, chunked_grads):
+        np.testing.assert_allclose(tf.convert_to_tensor(grad).numpy(), tf.convert_to_tensor(chunked_grad).numpy(),
+                                   rtol=1e-2, atol=1e-2)
+
+
+# 학습 step 에서 attention weights 를 모을 때(return_attention=True)와 건너뛸 때의 peak 메모리 비교.
+# ru_maxrss 는 프로세스 전체의 최대값이라 줄어들지 않으므로, 메모리를 덜 쓰는 return_attention=False 를 먼저 잰다.
+if RUN_BENCHMARKS:
+    def benchmark_return_attention(return_attention, batch, n_steps=10):
+        @tf.function
+        def bench_step(inp, tar, inp_lengths, tar_lengths):
+            tar_inp = tar[:, :-1]
+            tar_real = tar[:, 1:]
+            enc_padding_mask, combined_mask, dec_padding_mask = create_masks(inp, tar_inp, inp_lengths, tar_lengths)
+
+            with tf.GradientTape() as tape:
+                predictions, _ = model(inp, tar_inp, True, enc_padding_mask, combined_mask, dec_padding_mask,
+                                       return_attention=return_attention)
+                loss = loss_function(tar_real, predictions)
+            return tape.gradient(loss, model.trainable_variables)
+
+        has_gpu = bool(tf.config.list_physical_devices('GPU'))
+        if has_gpu:
+            tf.config.experimental.reset_memory_stats('GPU:0')
+
+        for _ in range(n_steps):
+            bench_step(*batch)
+
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10  # Linux 에서 ru_maxrss 는 KB 단위
+        peak_memory = tf.config.experimental.get_memory_info('GPU:0')['peak'] / 2**20 if has_gpu else float('nan')
+        return peak_rss, peak_memory
+
+    peak_rss = {}
+    for return_attention in (False, True):
+        peak_rss[return_attention], peak_memory = benchmark_return_attention(return_attention, bench_batch)
+        print('return_attention={:5s} : peak RSS {:.0f} MB, peak GPU memory {:.0f} MB'.format(
+            str(return_attention), peak_rss[return_attention], peak_memory))
+    print('peak RSS difference : {:.0f} MB'.format(peak_rss[True] - peak_rss[False]))
+
+
+# 길이로 만든 bool 마스크가 토큰 0 을 훑어 만든 float 마스크(이전 방식)와 같은지 확인하고, 마스크를 만드는 시간을 비교한다.
+if RUN_BENCHMARKS:
+    def token_padding_mask(seq):
+        return tf.cast(tf.math.equal(seq, 0), tf.float32)[:, tf.newaxis, tf.newaxis, :]
+
+    def benchmark_masks(make_masks, n_steps=100):
+        make_masks = tf.function(make_masks)
+        make_masks()
+        start = time.time()
+        for _ in range(n_steps):
+            make_masks()
+        return (time.time() - start) / n_steps
+
+    mask_lengths = tf.random.uniform((BATCH_SIZE,), 1, ENCODER_LEN + 1, dtype=tf.int32)
+    mask_seq     = tf.sequence_mask(mask_lengths, ENCODER_LEN, dtype=tf.int32) * 5
+    np.testing.assert_array_equal(create_padding_mask(mask_seq).numpy(), token_padding_mask(mask_seq).numpy() > 0)
+    np.testing.assert_array_equal(create_padding_mask(mask_seq, mask_lengths).numpy(), token_padding_mask(mask_seq).numpy() > 0)
+
+    def token_look_ahead_mask(seq):
+        positions = tf.range(tf.shape(seq)[1])
+        look_ahead_mask = tf.cast(positions[tf.newaxis, :] > positions[:, tf.newaxis], tf.float32)
+        return tf.maximum(token_padding_mask(seq), look_ahead_mask)
+
+    for size in (1, DECODER_LEN, MAX_MASK_LEN):
+        np.testing.assert_array_equal(create_look_ahead_mask(size).numpy(), np.triu(np.ones((size, size), dtype=bool), k=1))
+    with np.testing.assert_raises(tf.errors.InvalidArgumentError):
+        create_look_ahead_mask(MAX_MASK_LEN + 1)
+    np.testing.assert_array_equal(
+        tf.logical_or(create_padding_mask(mask_seq, mask_lengths), create_look_ahead_mask(ENCODER_LEN)).numpy(),
+        token_look_ahead_mask(mask_seq).numpy() > 0)
+
+    print('token scan mask   : {:.6f} sec'.format(benchmark_masks(lambda: token_look_ahead_mask(mask_seq))))
+    print('length based mask : {:.6f} sec'.format(benchmark_masks(lambda: tf.logical_or(
+        create_padding_mask(mask_seq, mask_lengths), create_look_ahead_mask(ENCODER_LEN)))))
+
+
+# 위치 표는 hid_dim 마다 한 번만 만들어진다. 늘어난 표의 앞부분은 원래 표와 같고, 짧은 길이 요청은 늘어난 표를 그대로 쓴다.
+if RUN_BENCHMARKS:
+    POSITION_TABLES.clear()
+    short_table = sinusoid_position_table(ENCODER_LEN, hid_dim)
+    long_table  = sinusoid_position_table(4 * ENCODER_LEN, hid_dim)
+    np.testing.assert_allclose(short_table.numpy(), long_table.numpy()[:, :ENCODER_LEN], atol=1e-6)
+    assert sinusoid_position_table(ENCODER_LEN, hid_dim) is long_table
+
+    # 모델마다 encoder, decoder 가 표를 따로 만들던 방식과, 공유 표를 가져오는 방식의 시간 비교
+    n_models = 20
+    start = time.time()
+    for _ in range(n_models):
+        get_sinusoid_encoding_table(512, hid_dim), get_sinusoid_encoding_table(512, hid_dim)
+    print('per-layer tables : {:.4f} sec/model'.format((time.time() - start) / n_models))
+    start = time.time()
+    for _ in range(n_models):
+        sinusoid_position_table(512, hid_dim), sinusoid_position_table(512, hid_dim)
+    print('shared table     : {:.4f} sec/model'.format((time.time() - start) / n_models))
+
+
+# 행마다 sequences_to_texts 를 부르던 방식과 detokenize 의 결과와 시간을 비교한다.
+# (시작 토큰 + 일반 단어 + 종료 토큰 + 패딩) 으로 된 id 행렬을 만든다.
+if RUN_BENCHMARKS:
+    n_detok       = 1024
+    normal_ids    = np.setdiff1d(np.arange(1, len(TRG_words)), TRG_special_ids)
+    detok_ids     = np.random.choice(normal_ids, size=(n_detok, DECODER_LEN + 1))
+    detok_lengths = np.random.randint(1, DECODER_LEN + 1, size=n_detok)
+    detok_ids[:, 0] = TRG_tokenizer.word_index['<sos>']
+    detok_ids[np.arange(n_detok), detok_lengths] = TRG_tokenizer.word_index['<eos>']
+    detok_ids[np.arange(DECODER_LEN + 1)[np.newaxis, :] > detok_lengths[:, np.newaxis]] = 0
+
+    start = time.time()
+    loop_texts = [TRG_tokenizer.sequences_to_texts([row[1:length]])[0] for row, length in zip(detok_ids, detok_lengths)]
+    loop_time = time.time() - start
+
+    start = time.time()
+    detok_texts = detokenize(detok_ids)
+    detok_time = time.time() - start
+    assert detok_texts == loop_texts
+
+    print('sequences_to_texts per row : {:.0f} sentences/sec'.format(n_detok / loop_time))
+    print('detokenize                 : {:.0f} sentences/sec'.format(n_detok / detok_time))
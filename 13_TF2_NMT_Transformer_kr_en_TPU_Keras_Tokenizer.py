@@ -40,6 +40,9 @@ BUFFER_SIZE = 20000
 
 N_EPOCHS = 200
 
+# 스크립트 끝의 속도/결과 비교(benchmark)는 오래 걸리고 메모리를 많이 쓰므로 필요할 때만 켠다.
+RUN_BENCHMARKS = False
+
 import urllib3
 import zipfile
 import shutil
@@ -47,48 +50,134 @@ import pandas as pd
 
 pd.set_option('display.max_colwidth', None)
 
-http = urllib3.PoolManager()
-url = 'https://raw.githubusercontent.com/Huffon/pytorch-transformer-kor-eng/master/data/corpus.csv'
-filename = 'corpus.csv'
-path = os.getcwd()
-zipfilename = os.path.join(path, filename)
-with http.request('GET', url, preload_content=False) as r, open(zipfilename, 'wb') as out_file:       
-    shutil.copyfileobj(r, out_file)
-
-total_df = pd.read_csv('corpus.csv')
-
-total_df.rename(columns={"english": "SRC"}, errors="raise", inplace=True)
-total_df.rename(columns={"korean": "TRG"}, errors="raise", inplace=True)
-
-total_df["src_len"] = ""
-total_df["trg_len"] = ""
-total_df.head()
-
-for idx in range(len(total_df['SRC'])):
-    # initialize string
-    text_eng = str(total_df.iloc[idx]['SRC'])
-
-    # default separator: space
-    result_eng = len(text_eng.split())
-    total_df.at[idx, 'src_len'] = int(result_eng)
-
-    text_fra = str(total_df.iloc[idx]['TRG'])
-    # default separator: space
-    result_fra = len(text_fra.split())
-    total_df.at[idx, 'trg_len'] = int(result_fra)
-
-print('Translation Pair :',len(total_df)) # 리뷰 개수 출력
-
-total_df = total_df.drop_duplicates(subset = ["SRC"])
-print('Translation Pair :',len(total_df)) # 리뷰 개수 출력
-
-total_df = total_df.drop_duplicates(subset = ["TRG"])
-print('Translation Pair :',len(total_df)) # 리뷰 개수 출력
+import hashlib
+import json
+
+""" corpus resolver """
+# 로컬 cache 를 먼저 확인하고, cache 에 없을 때만 네트워크에서 받습니다.
+# CORPUS_PATH 환경 변수로 파일, 디렉토리 또는 file:// 경로를 지정하면 네트워크를 전혀 사용하지 않습니다.
+CORPUS_URL       = 'https://raw.githubusercontent.com/Huffon/pytorch-transformer-kor-eng/master/data/corpus.csv'
+CORPUS_SHA256    = os.environ.get('CORPUS_SHA256')
+CORPUS_OVERRIDE  = os.environ.get('CORPUS_PATH')
+CORPUS_CACHE_DIR = os.environ.get('CORPUS_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'tf2_nmt_kr_en'))
+
+def file_sha256(filename, block_size=1 << 20):
+    hasher = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+def resolve_corpus(url=CORPUS_URL, sha256=CORPUS_SHA256, override=CORPUS_OVERRIDE, cache_dir=CORPUS_CACHE_DIR):
+    """Return a local path to the corpus file, downloading only on a cache miss.
+    cache 는 내용의 sha256 을 파일 이름으로 하는 blobs/ 와 URL 별로 blob 을 가리키는 urls/ 로 구성됩니다.
+    sha256 을 지정하면 override 파일, cache, 새로 받은 파일 모두 checksum 을 검사합니다.
+    """
+    filename = url.rsplit('/', 1)[-1]
+
+    if override:
+        path = override[len('file://'):] if override.startswith('file://') else override
+        if os.path.isdir(path):
+            path = os.path.join(path, filename)
+        if not os.path.isfile(path):
+            raise FileNotFoundError('corpus override not found: %s' % path)
+        if sha256 and file_sha256(path) != sha256:
+            raise ValueError('checksum mismatch for %s' % path)
+        return path
+
+    blob_dir = os.path.join(cache_dir, 'blobs')
+    url_dir  = os.path.join(cache_dir, 'urls')
+    os.makedirs(blob_dir, exist_ok=True)
+    os.makedirs(url_dir, exist_ok=True)
+    url_index = os.path.join(url_dir, hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+    digest = sha256
+    if digest is None and os.path.exists(url_index):
+        with open(url_index, encoding='utf-8') as f:
+            digest = json.load(f)['sha256']
+
+    # cache hit: 내용이 blob 이름(sha256)과 일치할 때만 사용
+    if digest is not None:
+        blob = os.path.join(blob_dir, digest)
+        if os.path.isfile(blob):
+            if file_sha256(blob) == digest:
+                return blob
+            os.remove(blob)
+
+    # cache miss: 임시 파일로 받은 뒤 검증하고 blob 으로 옮깁니다.
+    print('Downloading corpus      :', url)
+    download = os.path.join(blob_dir, 'download.%d.tmp' % os.getpid())
+    http = urllib3.PoolManager()
+    with http.request('GET', url, preload_content=False) as r, open(download, 'wb') as out_file:
+        if r.status != 200:
+            raise IOError('failed to download %s (HTTP %d)' % (url, r.status))
+        shutil.copyfileobj(r, out_file)
+
+    digest = file_sha256(download)
+    if sha256 and digest != sha256:
+        os.remove(download)
+        raise ValueError('checksum mismatch for %s' % url)
+
+    blob = os.path.join(blob_dir, digest)
+    os.replace(download, blob)
+    with open(url_index, 'w', encoding='utf-8') as f:
+        json.dump({'url': url, 'sha256': digest}, f)
+    return blob
+
+filename = resolve_corpus()
+
+CHUNK_SIZE = 100000
+MIN_LEN    = 7
+MAX_LEN    = 20
+
+def load_corpus(filename, chunksize=CHUNK_SIZE, min_len=MIN_LEN, max_len=MAX_LEN):
+    """Stream a parallel corpus CSV and return the filtered, de-duplicated pairs.
+    파일을 chunk 단위로 읽어서 단어 수를 벡터 연산으로 계산하고,
+    SRC -> TRG 순서의 중복 제거와 min_len < 길이 <= max_len 필터를 chunk 마다 적용합니다.
+    중복 검사는 문장 대신 64bit hash 만 보관하므로 수천만 쌍의 corpus 도 처리할 수 있습니다.
+    결과는 전체를 한번에 읽어서 처리했을 때와 같은 행, 같은 순서입니다.
+    """
+    seen_src = set()
+    seen_trg = set()
+    counts   = [0, 0, 0]
+    frames   = []
+
+    reader = pd.read_csv(filename, usecols=['english', 'korean'], chunksize=chunksize)
+    for chunk in reader:
+        chunk = chunk.rename(columns={"english": "SRC", "korean": "TRG"}, errors="raise")
+        counts[0] += len(chunk)
+
+        # 앞선 chunk 와 현재 chunk 안에서 이미 나온 SRC 제거 (첫번째 행 유지)
+        src_hash = pd.util.hash_pandas_object(chunk['SRC'].astype(str), index=False)
+        is_new   = ~(src_hash.map(seen_src.__contains__) | src_hash.duplicated())
+        seen_src.update(src_hash[is_new])
+        chunk    = chunk[is_new.values]
+        counts[1] += len(chunk)
+
+        # SRC 중복이 제거된 행들에 대해 TRG 중복 제거
+        trg_hash = pd.util.hash_pandas_object(chunk['TRG'].astype(str), index=False)
+        is_new   = ~(trg_hash.map(seen_trg.__contains__) | trg_hash.duplicated())
+        seen_trg.update(trg_hash[is_new])
+        chunk    = chunk[is_new.values]
+        counts[2] += len(chunk)
+
+        # default separator: space
+        src_len = chunk['SRC'].astype(str).str.split().str.len()
+        trg_len = chunk['TRG'].astype(str).str.split().str.len()
+
+        # 그 결과를 새로운 변수에 할당합니다.
+        is_within_len = (min_len < src_len) & (src_len <= max_len) & (min_len < trg_len) & (trg_len <= max_len)
+        chunk = chunk[is_within_len].assign(src_len=src_len[is_within_len].astype('int16'),
+                                            trg_len=trg_len[is_within_len].astype('int16'))
+        frames.append(chunk)
+
+    for count in counts:
+        print('Translation Pair :', count) # 리뷰 개수 출력
+
+    return pd.concat(frames)
 
-# 그 결과를 새로운 변수에 할당합니다.
-is_within_len = (7 < total_df['src_len']) & (total_df['src_len'] <= 20) & (7 < total_df['trg_len']) & (total_df['trg_len'] <=20)
 # 조건를 충족하는 데이터를 필터링하여 새로운 변수에 저장합니다.
-total_df = total_df[is_within_len]
+total_df = load_corpus(filename)
 print('챗봇 샘플의 개수 :', len(total_df))
 
 train_data = total_df.sample(n=1024*8, # number of items from axis to return.
@@ -99,37 +188,47 @@ print('챗봇 샘플의 개수 :', len(train_data))
 
 print(train_data.isnull().sum())
 
-raw_src = []
-for sentence in train_data['SRC']:
-    sentence = sentence.lower().strip()
-    # creating a space between a word and the punctuation following it
-    # eg: "he is a boy." => "he is a boy ."
-    sentence = re.sub(r"([?.!,])", r" \1 ", sentence)
-    sentence = re.sub(r'[" "]+', " ", sentence)
-    # removing contractions
-    sentence = re.sub(r"i'm", "i am", sentence)
-    sentence = re.sub(r"he's", "he is", sentence)
-    sentence = re.sub(r"she's", "she is", sentence)
-    sentence = re.sub(r"it's", "it is", sentence)
-    sentence = re.sub(r"that's", "that is", sentence)
-    sentence = re.sub(r"what's", "that is", sentence)
-    sentence = re.sub(r"where's", "where is", sentence)
-    sentence = re.sub(r"how's", "how is", sentence)
-    sentence = re.sub(r"\'ll", " will", sentence)
-    sentence = re.sub(r"\'ve", " have", sentence)
-    sentence = re.sub(r"\'re", " are", sentence)
-    sentence = re.sub(r"\'d", " would", sentence)
-    sentence = re.sub(r"\'re", " are", sentence)
-    sentence = re.sub(r"won't", "will not", sentence)
-    sentence = re.sub(r"can't", "cannot", sentence)
-    sentence = re.sub(r"n't", " not", sentence)
-    sentence = re.sub(r"n'", "ng", sentence)
-    sentence = re.sub(r"'bout", "about", sentence)
-    # replacing everything with space except (a-z, A-Z, ".", "?", "!", ",")
-    sentence = re.sub(r"[^a-zA-Z?.!,]+", " ", sentence)
-    sentence = sentence.strip()
-    raw_src.append(sentence)
-
+""" English normalization """
+# 축약형 치환 규칙. 순서대로 적용했을 때의 결과를 기준으로 합니다.
+EN_CONTRACTIONS = [
+    ("i'm", "i am"), ("he's", "he is"), ("she's", "she is"), ("it's", "it is"),
+    ("that's", "that is"), ("what's", "that is"), ("where's", "where is"), ("how's", "how is"),
+    ("'ll", " will"), ("'ve", " have"), ("'re", " are"), ("'d", " would"),
+    ("won't", "will not"), ("can't", "cannot"), ("n't", " not"), ("n'", "ng"), ("'bout", "about"),
+]
+EN_CONTRACTION_TABLE = dict(EN_CONTRACTIONS)
+
+# 축약형은 두 번의 정규식 치환으로 바꿉니다.
+# 단어 전체 축약형(i'm ~ how's)의 결과는 뒤 규칙과 이어질 수 있으므로 ("don'that's" -> "don'that is" -> "do nothat is")
+# 먼저 따로 치환하고, 나머지 규칙은 한 번에 치환합니다.
+EN_WORD_CONTRACTION_RE = re.compile(r"i'm|she's|he's|it's|that's|what's|where's|how's")
+# "n'" 는 순차 적용에서 'll/'ve/'re/'d 가 먼저 바뀌므로 그 앞에서는 매칭하지 않습니다.
+EN_CONTRACTION_RE = re.compile(r"'ll|'ve|'re|'d|won't|can't|n't|n'(?!ll|ve|re|d)|'bout")
+# 알파벳 단어와 구두점(?.!,)을 각각 하나의 토큰으로 분리. 나머지 문자는 모두 공백으로 취급됩니다.
+EN_TOKEN_RE = re.compile(r"[a-zA-Z]+|[?.!,]")
+
+def normalize_en(sentence):
+    """Lowercase, expand contractions and space out punctuation.
+    eg: "He's a boy." => "he is a boy ."
+    """
+    sentence = sentence.lower()
+    for pattern in (EN_WORD_CONTRACTION_RE, EN_CONTRACTION_RE):
+        sentence = pattern.sub(lambda m: EN_CONTRACTION_TABLE[m.group()], sentence)
+    return " ".join(EN_TOKEN_RE.findall(sentence))
+
+def normalize_en_tf(sentences):
+    """Same normalization as normalize_en() on a string tensor, usable inside tf.data.map.
+    RE2 는 lookahead 를 지원하지 않으므로 축약형은 규칙 순서대로 배치 단위로 치환합니다.
+    """
+    sentences = tf.strings.lower(sentences, encoding='utf-8')
+    for pattern, rewrite in EN_CONTRACTIONS:
+        sentences = tf.strings.regex_replace(sentences, pattern, rewrite)
+    sentences = tf.strings.regex_replace(sentences, r"[^a-zA-Z?.!,]+", " ")
+    sentences = tf.strings.regex_replace(sentences, r"([?.!,])", r" \1 ")
+    sentences = tf.strings.regex_replace(sentences, r" +", " ")
+    return tf.strings.strip(sentences)
+
+raw_src = [normalize_en(sentence) for sentence in train_data['SRC']]
 raw_trg = []
 for sentence in train_data['TRG']:
     # 구두점에 대해서 띄어쓰기
@@ -161,12 +260,82 @@ trg_sentence  = raw_trg.apply(lambda x: "<SOS> "+ x + " <EOS>")
 filters = '!"#$%&()*+,-./:;=?@[\\]^_`{|}~\t\n'
 oov_token = '<unk>'
 
-# Define tokenizer
-SRC_tokenizer = tf.keras.preprocessing.text.Tokenizer(filters = filters, oov_token=oov_token)
-TRG_tokenizer = tf.keras.preprocessing.text.Tokenizer(filters = filters, oov_token=oov_token)
-
-SRC_tokenizer.fit_on_texts(src_sentence)
-TRG_tokenizer.fit_on_texts(trg_sentence)
+TOKENIZER_SETTINGS = {'type': 'keras', 'filters': filters, 'oov_token': oov_token}
+SPECIAL_WORDS = ['<sos>', '<eos>']
+
+def save_tokenizer(tokenizer, prefix):
+    with open(prefix + '.json', 'w', encoding='utf-8') as f:
+        f.write(tokenizer.to_json())
+
+def load_tokenizer(prefix):
+    with open(prefix + '.json', encoding='utf-8') as f:
+        return tf.keras.preprocessing.text.tokenizer_from_json(f.read())
+
+def build_tokenizers(sources, targets):
+    """Fit the Keras tokenizers and look up the ids of the special tokens."""
+    # Define tokenizer
+    src_tokenizer = tf.keras.preprocessing.text.Tokenizer(filters = filters, oov_token=oov_token)
+    trg_tokenizer = tf.keras.preprocessing.text.Tokenizer(filters = filters, oov_token=oov_token)
+
+    src_tokenizer.fit_on_texts(sources)
+    trg_tokenizer.fit_on_texts(targets)
+
+    special_tokens = {
+        'SRC': {word: src_tokenizer.word_index[word] for word in SPECIAL_WORDS if word in src_tokenizer.word_index},
+        'TRG': {word: trg_tokenizer.word_index[word] for word in SPECIAL_WORDS if word in trg_tokenizer.word_index},
+    }
+    return src_tokenizer, trg_tokenizer, special_tokens
+
+""" tokenizer artifact store """
+# 한 번 만든 tokenizer 를 corpus 와 설정의 hash 로 저장해두고 다음 실행부터는 불러옵니다.
+# 추론만 할 때는 load_tokenizers() 로 마지막에 저장한 tokenizer 를 corpus 없이 불러올 수 있습니다.
+TOKENIZER_DIR = os.path.join(os.getcwd(), 'tokenizers')
+
+def tokenizer_key(settings, sources, targets):
+    """Hash of the tokenizer settings and every sentence it is built from."""
+    hasher = hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8'))
+    for corpus in (sources, targets):
+        for sentence in corpus:
+            hasher.update(str(sentence).encode('utf-8'))
+            hasher.update(b'\n')
+        hasher.update(b'\0')
+    return hasher.hexdigest()[:16]
+
+def save_tokenizers(key, src_tokenizer, trg_tokenizer, special_tokens, settings):
+    """Write both vocabularies and config.json (written last, marks a complete artifact)."""
+    path = os.path.join(TOKENIZER_DIR, key)
+    os.makedirs(path, exist_ok=True)
+    save_tokenizer(src_tokenizer, os.path.join(path, 'src'))
+    save_tokenizer(trg_tokenizer, os.path.join(path, 'trg'))
+
+    config = {'settings': settings, 'special_tokens': special_tokens}
+    with open(os.path.join(path, 'config.json'), 'w', encoding='utf-8') as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+    with open(os.path.join(TOKENIZER_DIR, 'latest'), 'w', encoding='utf-8') as f:
+        f.write(key)
+
+def load_tokenizers(key=None):
+    """Load (src_tokenizer, trg_tokenizer, special_tokens). key 가 없으면 마지막으로 저장한 것을 불러옵니다."""
+    if key is None:
+        with open(os.path.join(TOKENIZER_DIR, 'latest'), encoding='utf-8') as f:
+            key = f.read().strip()
+    path = os.path.join(TOKENIZER_DIR, key)
+    with open(os.path.join(path, 'config.json'), encoding='utf-8') as f:
+        config = json.load(f)
+    return load_tokenizer(os.path.join(path, 'src')), load_tokenizer(os.path.join(path, 'trg')), config['special_tokens']
+
+def build_or_load_tokenizers(sources, targets, settings=TOKENIZER_SETTINGS):
+    key = tokenizer_key(settings, sources, targets)
+    if os.path.exists(os.path.join(TOKENIZER_DIR, key, 'config.json')):
+        print('Tokenizer 불러오기       :', key)
+        return load_tokenizers(key)
+
+    src_tokenizer, trg_tokenizer, special_tokens = build_tokenizers(sources, targets)
+    save_tokenizers(key, src_tokenizer, trg_tokenizer, special_tokens, settings)
+    print('Tokenizer 저장           :', key)
+    return src_tokenizer, trg_tokenizer, special_tokens
+
+SRC_tokenizer, TRG_tokenizer, special_tokens = build_or_load_tokenizers(src_sentence, trg_sentence)
 
 n_enc_vocab = len(SRC_tokenizer.word_index) + 1
 n_dec_vocab = len(TRG_tokenizer.word_index) + 1
@@ -224,16 +393,91 @@ pf_dim    = 1024
 n_heads   = 8
 dropout   = 0.3
 
-# 디코더의 실제값 시퀀스에서는 시작 토큰을 제거해야 한다.
-dataset = tf.data.Dataset.from_tensor_slices((
-    {
-        'inputs': tkn_sources,
-        'dec_inputs': tkn_targets[:, :-1] # 디코더의 입력. 마지막 패딩 토큰이 제거된다.
-    },
-    {
-        'outputs': tkn_targets[:, 1:]  # 맨 처음 토큰이 제거된다. 다시 말해 시작 토큰이 제거된다.
-    },
-))
+""" sharded TFRecord export / import """
+# 토큰화된 문장 쌍을 여러 개의 TFRecord shard 로 저장하고, interleave 로 여러 파일을 병렬로 읽습니다.
+# 여러 worker 가 CSV 를 다시 읽지 않고 각자 다른 shard 를 읽을 수 있습니다. (gs:// 경로도 사용 가능)
+USE_TFRECORD      = False
+TFRECORD_DIR      = os.path.join(os.getcwd(), 'tfrecords')
+N_TFRECORD_SHARDS = 8
+
+def write_tfrecord_shards(path, chunks, pad_values=None, n_shards=N_TFRECORD_SHARDS):
+    """Write chunks of padded rows ({field 이름: 2D 배열}) to n_shards TFRecord files.
+    i 번째 문장은 i % n_shards 번째 shard 에 기록되고, 각 행의 뒤쪽 패딩은 저장하지 않습니다.
+    """
+    pad_values = pad_values or {}
+    tf.io.gfile.makedirs(path)
+    writers = [tf.io.TFRecordWriter(os.path.join(path, 'data-%05d-of-%05d.tfrecord' % (shard, n_shards)))
+               for shard in range(n_shards)]
+    widths = {}
+    n_rows = 0
+
+    for chunk in chunks:
+        chunk = {name: np.asarray(rows) for name, rows in chunk.items()}
+        for name, rows in chunk.items():
+            widths[name] = rows.shape[1]
+
+        for row in range(len(next(iter(chunk.values())))):
+            feature = {}
+            for name, rows in chunk.items():
+                ids = rows[row]
+                not_pad = np.flatnonzero(ids != pad_values.get(name, 0))
+                ids = ids[:not_pad[-1] + 1] if len(not_pad) else ids[:0]
+                feature[name] = tf.train.Feature(int64_list=tf.train.Int64List(value=ids))
+            example = tf.train.Example(features=tf.train.Features(feature=feature))
+            writers[n_rows % n_shards].write(example.SerializeToString())
+            n_rows += 1
+
+    for writer in writers:
+        writer.close()
+
+    meta = {'n_rows': n_rows, 'n_shards': n_shards,
+            'fields': {name: {'width': widths[name], 'pad': int(pad_values.get(name, 0))} for name in widths}}
+    with tf.io.gfile.GFile(os.path.join(path, 'meta.json'), 'w') as f:
+        f.write(json.dumps(meta, indent=2))
+
+def tfrecord_dataset(path, names, deterministic=True, num_input_shards=1, input_shard_index=0):
+    """Read the shards with parallel interleave and return padded rows for the given fields.
+    deterministic=False 이면 파일 순서를 섞고 먼저 준비된 레코드부터 내보내서 처리량을 높입니다.
+    num_input_shards / input_shard_index 로 worker 마다 서로 다른 파일을 읽게 할 수 있습니다.
+    """
+    with tf.io.gfile.GFile(os.path.join(path, 'meta.json')) as f:
+        fields = json.loads(f.read())['fields']
+    features = {name: tf.io.VarLenFeature(tf.int64) for name in names}
+
+    def parse(record):
+        example = tf.io.parse_single_example(record, features)
+        rows = []
+        for name in names:
+            width, pad = fields[name]['width'], fields[name]['pad']
+            row = tf.sparse.to_dense(example[name])
+            row = tf.pad(row, [[0, width - tf.shape(row)[0]]], constant_values=pad)
+            row.set_shape([width])
+            rows.append(row)
+        return tuple(rows)
+
+    files = tf.data.Dataset.list_files(os.path.join(path, 'data-*.tfrecord'), shuffle=not deterministic)
+    files = files.shard(num_input_shards, input_shard_index)
+    dataset = files.interleave(tf.data.TFRecordDataset, num_parallel_calls=AUTO, deterministic=deterministic)
+    return dataset.map(parse, num_parallel_calls=AUTO, deterministic=deterministic)
+
+if USE_TFRECORD:
+    TFRECORD_PATH = os.path.join(TFRECORD_DIR, tokenizer_key(
+        {'tokenizer': TOKENIZER_SETTINGS, 'encoder_len': ENCODER_LEN, 'decoder_len': DECODER_LEN}, raw_src, raw_trg))
+    if not tf.io.gfile.exists(os.path.join(TFRECORD_PATH, 'meta.json')):
+        write_tfrecord_shards(TFRECORD_PATH, [{'src': tkn_sources, 'trg': tkn_targets}])
+    dataset = tfrecord_dataset(TFRECORD_PATH, ('src', 'trg'))
+    dataset = dataset.map(lambda src, trg: ({'inputs': src, 'dec_inputs': trg[:-1]}, {'outputs': trg[1:]}))
+else:
+    # 디코더의 실제값 시퀀스에서는 시작 토큰을 제거해야 한다.
+    dataset = tf.data.Dataset.from_tensor_slices((
+        {
+            'inputs': tkn_sources,
+            'dec_inputs': tkn_targets[:, :-1] # 디코더의 입력. 마지막 패딩 토큰이 제거된다.
+        },
+        {
+            'outputs': tkn_targets[:, 1:]  # 맨 처음 토큰이 제거된다. 다시 말해 시작 토큰이 제거된다.
+        },
+    ))
 
 dataset = dataset.cache()
 dataset = dataset.shuffle(BUFFER_SIZE)
@@ -247,10 +491,29 @@ print(tkn_targets[:1][:, 1:]) # 맨 처음 토큰이 제거된다. 다시 말해
 
 """ sinusoid position encoding """
 class get_sinusoid_encoding_table(tf.keras.layers.Layer):
+    # encoder 와 decoder (그리고 다시 만든 모델)는 hid_dim 마다 하나의 위치 표를 함께 쓴다.
+    # 표는 처음 필요할 때 만들고, 더 긴 입력이 오면 두 배 이상으로 늘려 다시 만든다.
+    tables = {}
 
     def __init__(self, position, hid_dim):
         super(get_sinusoid_encoding_table, self).__init__()
-        self.pos_encoding = self.positional_encoding(position, hid_dim)
+        self.position = position
+        self.hid_dim  = hid_dim
+
+    @property
+    def pos_encoding(self):
+        return self.shared_table(self.position)
+
+    def shared_table(self, position):
+        table = self.tables.get(self.hid_dim)
+        if table is None or table.shape[1] < position:
+            if table is not None:
+                position = max(position, 2 * table.shape[1])
+            # 그래프 안에서 처음 불려도 eager 텐서로 만들어 다른 그래프에서도 쓸 수 있게 한다.
+            with tf.init_scope():
+                table = self.positional_encoding(position, self.hid_dim)
+            self.tables[self.hid_dim] = table
+        return table
 
     def get_angles(self, position, i, hid_dim):
         angles = 1 / tf.pow(10000, (2 * (i // 2)) / tf.cast(hid_dim, tf.float32))
@@ -278,7 +541,11 @@ class get_sinusoid_encoding_table(tf.keras.layers.Layer):
         return tf.cast(pos_encoding, tf.float32)
 
     def call(self, inputs):
-        return inputs + self.pos_encoding[:, :tf.shape(inputs)[1], :]
+        pos_encoding = self.shared_table(max(self.position, inputs.shape[1] or 0))
+        return inputs + pos_encoding[:, :tf.shape(inputs)[1], :]
+
+# 위치 표는 어휘 크기가 아니라 최대 문장 길이(디코딩 중에는 시작 토큰 포함 DECODER_LEN + 1)로 만든다.
+MAX_POSITION_LEN = max(ENCODER_LEN, DECODER_LEN) + 1
 
 sample_pos_encoding = get_sinusoid_encoding_table(50, 128)
 
@@ -463,7 +730,7 @@ def encoder(n_enc_vocab, n_layers, pf_dim, hid_dim, n_heads, dropout,
     # adding embedding and position encoding.
     emb = tf.keras.layers.Embedding(n_enc_vocab, hid_dim)(inputs)
     emb *= tf.math.sqrt(tf.cast(hid_dim, tf.float32))
-    emb = get_sinusoid_encoding_table(n_enc_vocab, hid_dim)(emb)
+    emb = get_sinusoid_encoding_table(MAX_POSITION_LEN, hid_dim)(emb)
     outputs = tf.keras.layers.Dropout(rate=dropout)(emb)
 
     # 인코더를 n_layers개 쌓기
@@ -533,7 +800,7 @@ def decoder(n_dec_vocab, n_layers, pf_dim, hid_dim, n_heads, dropout,
     # adding embedding and position encoding.
     emb = tf.keras.layers.Embedding(n_dec_vocab, hid_dim)(inputs)
     emb *= tf.math.sqrt(tf.cast(hid_dim, tf.float32))
-    emb = get_sinusoid_encoding_table(n_dec_vocab, hid_dim)(emb)
+    emb = get_sinusoid_encoding_table(MAX_POSITION_LEN, hid_dim)(emb)
 
     outputs = tf.keras.layers.Dropout(rate=dropout)(emb)
 
@@ -683,7 +950,7 @@ if not os.path.exists("checkpoints"):
     os.makedirs("checkpoints")
 model.save_weights(checkpoint_path)
 
-def evaluate(text):
+def evaluate(text, reuse_encoder_output=True):
     text = SRC_tokenizer.texts_to_sequences([text])
     text = tf.keras.preprocessing.sequence.pad_sequences(text, maxlen=ENCODER_LEN,
                                                          padding='post', truncating='post')
@@ -693,9 +960,22 @@ def evaluate(text):
     decoder_input = [TRG_tokenizer.word_index['<sos>']]
     output = tf.expand_dims(decoder_input, 0)
 
+    if reuse_encoder_output:
+        # 인코더는 한 번만 실행하고, 학습된 디코더와 출력층만 매 시점 다시 호출한다.
+        # 디코더의 key/value 캐시는 없으므로 디코더는 매 시점 output 전체를 다시 계산한다.
+        enc_padding_mask = create_padding_mask(encoder_input)
+        enc_outputs = model.get_layer('encoder')(
+            [encoder_input, enc_padding_mask], training=False)
+
     # 디코더의 예측 시작
     for i in range(DECODER_LEN):
-        predictions = model(inputs=[encoder_input, output], training=False)
+        if reuse_encoder_output:
+            dec_outputs = model.get_layer('decoder')(
+                [output, enc_outputs, create_look_ahead_mask(output), enc_padding_mask],
+                training=False)
+            predictions = model.get_layer('outputs')(dec_outputs)
+        else:
+            predictions = model(inputs=[encoder_input, output], training=False)
 
         # 현재(마지막) 시점의 예측 단어를 받아온다.
         predictions = predictions[:, -1:, :]
@@ -710,15 +990,165 @@ def evaluate(text):
 
     return tf.squeeze(output, axis=0)
 
+def evaluate_batch(encoder_input):
+    """Greedy-decode a padded (batch_size, src_len) batch of source ids.
+    종료 토큰을 출력한 문장(finished)은 배치에서 제외하여 더 이상 계산하지 않는다.
+    Returns the output ids of each sentence (시작 토큰 포함, 종료 토큰 제외) in input order.
+    """
+    encoder_input = tf.convert_to_tensor(encoder_input)
+    batch_size = encoder_input.shape[0]
+
+    enc_padding_mask = create_padding_mask(encoder_input)
+    enc_outputs = model.get_layer('encoder')(
+        [encoder_input, enc_padding_mask], training=False)
+
+    output = tf.fill([batch_size, 1], TRG_tokenizer.word_index['<sos>'])
+    # 아직 번역 중인 문장들의 원래 배치 내 위치
+    active = np.arange(batch_size)
+    results = [None] * batch_size
+
+    # 디코더의 예측 시작
+    for i in range(DECODER_LEN):
+        dec_outputs = model.get_layer('decoder')(
+            [output, enc_outputs, create_look_ahead_mask(output), enc_padding_mask],
+            training=False)
+        predictions = model.get_layer('outputs')(dec_outputs)
+
+        predicted_id = tf.cast(tf.argmax(predictions[:, -1, :], axis=-1), tf.int32)
+        finished = tf.equal(predicted_id, TRG_tokenizer.word_index['<eos>']).numpy()
+
+        output = tf.concat([output, predicted_id[:, tf.newaxis]], axis=-1)
+
+        if finished.any():
+            for row in np.flatnonzero(finished):
+                results[active[row]] = output[row, :-1].numpy()
+
+            # 종료된 문장은 배치에서 제외
+            keep = np.flatnonzero(~finished)
+            if len(keep) == 0:
+                return results
+
+            active = active[keep]
+            output = tf.gather(output, keep)
+            enc_outputs = tf.gather(enc_outputs, keep)
+            enc_padding_mask = tf.gather(enc_padding_mask, keep)
+
+    for row, idx in enumerate(active):
+        results[idx] = output[row].numpy()
+
+    return results
+
+""" detokenize """
+# 번역 결과의 id 행렬을 한 번에 문장으로 바꾼다. id -> 단어 표와 특수 토큰 id 는 한 번만 만들어 둔다.
+TRG_words       = np.array([''] + [TRG_tokenizer.index_word[i] for i in range(1, len(TRG_tokenizer.index_word) + 1)],
+                           dtype=object)
+TRG_special_ids = np.array(list(special_tokens['TRG'].values()))
+
+def detokenize(predictions):
+    """Convert a (batch_size, len) id matrix into a list of sentences.
+    종료 토큰부터 뒤는 잘라내고, 특수 토큰과 패딩(0)은 vectorized 연산으로 한 번에 지운다.
+    """
+    predictions = np.asarray(predictions)
+    before_end  = np.cumsum(predictions == TRG_tokenizer.word_index['<eos>'], axis=1) == 0
+    keep  = before_end & (predictions != 0) & ~np.isin(predictions, TRG_special_ids)
+    words = TRG_words[predictions]
+    return [' '.join(row[row_keep]) for row, row_keep in zip(words, keep)]
+
+def translate_batch(sentences, batch_size=64):
+    """Translate a list of sentences, batch_size sentences at a time.
+    길이가 비슷한 문장끼리 묶어 패딩을 줄이고, 번역 결과는 입력 순서대로 반환한다.
+    """
+    tokenized = [seq[:ENCODER_LEN] for seq in SRC_tokenizer.texts_to_sequences(sentences)]
+    order = np.argsort([len(seq) for seq in tokenized], kind='stable')
+    translations = [None] * len(sentences)
+
+    for start in range(0, len(order), batch_size):
+        batch_idx = order[start:start + batch_size]
+        encoder_input = tf.keras.preprocessing.sequence.pad_sequences(
+            [tokenized[idx] for idx in batch_idx], padding='post')
+
+        # 문장마다 길이가 다르므로 뒤를 0 으로 채워 (batch_size, len) 행렬로 만든다.
+        predictions = tf.keras.preprocessing.sequence.pad_sequences(evaluate_batch(encoder_input), padding='post')
+
+        for idx, translation in zip(batch_idx, detokenize(predictions)):
+            translations[idx] = translation
+
+    return translations
+
 def predict(text):
-    prediction = evaluate(text=text).numpy()
-    prediction = prediction[1:]
-    predicted_sentence = TRG_tokenizer.sequences_to_texts([prediction])
-    
-    return predicted_sentence
+    return translate_batch([text])[0]
 
 for idx in (11, 21, 31, 41, 51):
     print("Input        :", raw_src[idx])
     print("Prediction   :", predict(raw_src[idx]))
     print("Ground Truth :", raw_trg[idx],"\n")
-    
\ No newline at end of file
+
+# 여러 문장을 배치 단위로 한 번에 번역
+if RUN_BENCHMARKS:
+    sentences = list(raw_src[:1024])
+
+    start = time.time()
+    translations = translate_batch(sentences, batch_size=64)
+    print('translate_batch : {:.1f} sentences/sec'.format(len(sentences) / (time.time() - start)))
+    
+
+
+# 영어 정규화(normalize_en, normalize_en_tf)와 기존 re.sub 루프의 속도 비교.
+# 규칙 순서대로 적용한 결과와 같은지는 tests/test_normalize_en.py 가 corpus 없이 확인한다.
+if RUN_BENCHMARKS:
+    def normalize_en_loop(sentence):
+        sentence = sentence.lower().strip()
+        sentence = re.sub(r"([?.!,])", r" \1 ", sentence)
+        sentence = re.sub(r'[" "]+', " ", sentence)
+        for pattern, rewrite in EN_CONTRACTIONS:
+            sentence = re.sub(pattern, rewrite, sentence)
+        sentence = re.sub(r"[^a-zA-Z?.!,]+", " ", sentence)
+        return sentence.strip()
+
+    samples = list(total_df['SRC'].astype(str))
+
+    sentences = (samples * (1000000 // len(samples) + 1))[:1000000]
+
+    start = time.time()
+    outputs_loop = [normalize_en_loop(sentence) for sentence in sentences]
+    loop_time = time.time() - start
+
+    start = time.time()
+    outputs = [normalize_en(sentence) for sentence in sentences]
+    single_pass_time = time.time() - start
+    assert outputs == outputs_loop
+
+    start = time.time()
+    normalized = tf.data.Dataset.from_tensor_slices(sentences).batch(4096)
+    normalized = normalized.map(normalize_en_tf, num_parallel_calls=AUTO)
+    outputs_tf = [sentence.decode('utf-8') for batch in normalized.as_numpy_iterator() for sentence in batch]
+    tf_data_time = time.time() - start
+    assert outputs_tf == outputs_loop
+
+    print('re.sub loop        : {:.0f} sentences/sec'.format(len(sentences) / loop_time))
+    print('normalize_en       : {:.0f} sentences/sec'.format(len(sentences) / single_pass_time))
+    print('normalize_en_tf    : {:.0f} sentences/sec'.format(len(sentences) / tf_data_time))
+
+
+# 행마다 sequences_to_texts 를 부르던 방식과 detokenize 의 결과와 시간을 비교한다.
+# (시작 토큰 + 일반 단어 + 종료 토큰 + 패딩) 으로 된 id 행렬을 만든다.
+if RUN_BENCHMARKS:
+    n_detok       = 1024
+    normal_ids    = np.setdiff1d(np.arange(1, len(TRG_words)), TRG_special_ids)
+    detok_ids     = np.random.choice(normal_ids, size=(n_detok, DECODER_LEN + 1))
+    detok_lengths = np.random.randint(1, DECODER_LEN + 1, size=n_detok)
+    detok_ids[:, 0] = TRG_tokenizer.word_index['<sos>']
+    detok_ids[np.arange(n_detok), detok_lengths] = TRG_tokenizer.word_index['<eos>']
+    detok_ids[np.arange(DECODER_LEN + 1)[np.newaxis, :] > detok_lengths[:, np.newaxis]] = 0
+
+    start = time.time()
+    loop_texts = [TRG_tokenizer.sequences_to_texts([row[1:length]])[0] for row, length in zip(detok_ids, detok_lengths)]
+    loop_time = time.time() - start
+
+    start = time.time()
+    detok_texts = detokenize(detok_ids)
+    detok_time = time.time() - start
+    assert detok_texts == loop_texts
+
+    print('sequences_to_texts per row : {:.0f} sentences/sec'.format(n_detok / loop_time))
+    print('detokenize                 : {:.0f} sentences/sec'.format(n_detok / detok_time))
@@ -0,0 +1,97 @@
+"""Offline test that greedy decoding with the key/value cache matches full recomputation.
+
+The model code (masks, attention, encoder/decoder, Transformer) and evaluate() are pulled out of
+the Transformer scripts with ast and run on a tiny randomly initialised model, so the test needs
+neither the corpus nor training. Tokenizers are replaced with fakes that map ids to themselves.
+"""
+import ast
+import glob
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+tf = pytest.importorskip('tensorflow')
+
+ROOT    = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS = sorted(glob.glob(os.path.join(ROOT, '1[12]_*.py')))
+
+N_VOCAB, START_ID, END_ID = 32, 1, 2
+MAX_LEN = 10
+MODEL_NAMES = {
+    'get_sinusoid_encoding_table', 'POSITION_TABLES', 'sinusoid_position_table',
+    'sequence_lengths', 'create_padding_mask', 'MAX_MASK_LEN', 'LOOK_AHEAD_MASK', 'create_look_ahead_mask',
+    'ScaledDotProductAttention', 'ChunkedDotProductAttention', 'MultiHeadAttentionLayer', 'fuse_attention_weights',
+    'PositionwiseFeedforwardLayer', 'EncoderLayer', 'Encoder', 'DecoderLayer', 'Decoder',
+    'create_masks', 'Transformer', 'evaluate',
+}
+SOURCES = ['5 6 7 8', '9 10 11 12 13 14 15', '3', '20 21 22 23 24 25 26 27 28 29']
+
+
+class FakeKerasTokenizer(object):
+    """texts_to_sequences / word_index of keras Tokenizer for texts of space separated ids."""
+    word_index = {'<sos>': START_ID, '<eos>': END_ID}
+
+    def texts_to_sequences(self, texts):
+        return [[int(token) for token in text.split()] for text in texts]
+
+
+class FakeSubwordTokenizer(object):
+    def encode(self, text):
+        return [int(token) for token in text.split()]
+
+
+def load_decoding(script):
+    with open(script, encoding='utf-8') as f:
+        tree = ast.parse(f.read(), script)
+
+    nodes = [node for node in tree.body
+             if (isinstance(node, (ast.FunctionDef, ast.ClassDef)) and node.name in MODEL_NAMES)
+             or (isinstance(node, ast.Assign) and any(isinstance(target, ast.Name) and target.id in MODEL_NAMES
+                                                     for target in node.targets))]
+    namespace = {
+        'tf': tf, 'np': np, 'ENCODER_LEN': MAX_LEN, 'DECODER_LEN': MAX_LEN,
+        'ATTENTION_CHUNK_SIZE': None, 'USE_FUSED_QKV': False,
+        # Keras tokenizer 스크립트
+        'SRC_tokenizer': FakeKerasTokenizer(), 'TRG_tokenizer': FakeKerasTokenizer(),
+        # Subword tokenizer 스크립트
+        'START_TOKEN': [START_ID], 'END_TOKEN': [END_ID], 'preprocess_sentence': lambda sentence: sentence,
+    }
+    if 'Subword' in script:
+        namespace['SRC_tokenizer'] = FakeSubwordTokenizer()
+    exec(compile(ast.Module(body=nodes, type_ignores=[]), script, 'exec'), namespace)
+    return namespace
+
+
+@pytest.fixture(params=SCRIPTS, ids=os.path.basename)
+def script(request):
+    return request.param
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_cached_greedy_matches_full_decoding(script, seed):
+    namespace = load_decoding(script)
+    tf.random.set_seed(seed)
+    namespace['model'] = namespace['Transformer'](
+        n_enc_vocab = N_VOCAB,
+        n_dec_vocab = N_VOCAB,
+        n_layers    = 2,
+        pf_dim      = 32,
+        hid_dim     = 16,
+        n_heads     = 2,
+        pe_input    = 64,
+        pe_target   = 64,
+        dropout     = 0.1)
+    evaluate = namespace['evaluate']
+
+    def decode(source, use_cache):
+        output = evaluate(source, use_cache=use_cache)
+        # Keras tokenizer 스크립트의 evaluate 는 (output, attention_weights) 를 반환한다.
+        if isinstance(output, tuple):
+            output = output[0]
+        return output.numpy().tolist()
+
+    for source in SOURCES:
+        cached = decode(source, use_cache=True)
+        assert cached[0] == START_ID and 1 <= len(cached) <= MAX_LEN + 1
+        assert cached == decode(source, use_cache=False), source
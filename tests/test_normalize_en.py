@@ -0,0 +1,78 @@
+"""Offline equivalence test for the English normalization shared by the training scripts.
+
+normalize_en must give the same result as applying EN_CONTRACTIONS one re.sub at a time in list
+order (the reference the scripts document). The normalization block is pulled out of each script
+with ast, so the test needs neither the corpus nor TensorFlow.
+"""
+import ast
+import glob
+import os
+import random
+import re
+
+import pytest
+
+ROOT    = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS = sorted(glob.glob(os.path.join(ROOT, '[0-9][0-9]_*.py')))
+
+CASES = [
+    "He's a boy.", "I'm sure she's here, isn't she?", "What's that? Where's he? How's it going!",
+    "n'll n're n'd n've n'bout won't can't don't she's what's",
+    # "n't" 가 앞선 규칙("that's", "what's")의 결과와 이어지는 경우
+    "don'that's", "rn'that's", "won'that's", "can'what's", "n'what's don'it's",
+    "he'she's", "it'she's", "'bout n'bout", "y'all ain't gonna", 'say "don\'t" twice',
+]
+PIECES = ["i'm", "he's", "she's", "it's", "that's", "what's", "where's", "how's", "'ll", "'ve", "'re", "'d",
+          "won't", "can't", "n't", "n'", "'bout", "'", "n", "t", "s", "h", "hat's", "wo", "ca", "ll", "d",
+          " ", ".", ",", '"']
+
+
+def load_normalize_en(script):
+    with open(script, encoding='utf-8') as f:
+        tree = ast.parse(f.read(), script)
+
+    nodes = [node for node in tree.body
+             if (isinstance(node, ast.FunctionDef) and node.name == 'normalize_en')
+             or (isinstance(node, ast.Assign) and all(isinstance(target, ast.Name) and target.id.startswith('EN_')
+                                                     for target in node.targets))]
+    namespace = {'re': re}
+    exec(compile(ast.Module(body=nodes, type_ignores=[]), script, 'exec'), namespace)
+    return namespace['normalize_en'], namespace['EN_CONTRACTIONS']
+
+
+def normalize_en_loop(sentence, contractions):
+    sentence = sentence.lower().strip()
+    sentence = re.sub(r"([?.!,])", r" \1 ", sentence)
+    sentence = re.sub(r'[" "]+', " ", sentence)
+    for pattern, rewrite in contractions:
+        sentence = re.sub(pattern, rewrite, sentence)
+    sentence = re.sub(r"[^a-zA-Z?.!,]+", " ", sentence)
+    return sentence.strip()
+
+
+def random_sentences(n=20000, seed=1234):
+    rng = random.Random(seed)
+    return [''.join(rng.choice(PIECES) for _ in range(rng.randint(1, 8))) for _ in range(n)]
+
+
+@pytest.fixture(params=SCRIPTS, ids=os.path.basename)
+def script(request):
+    return request.param
+
+
+def test_scripts_found():
+    assert len(SCRIPTS) == 12
+
+
+def test_known_cases(script):
+    normalize_en, contractions = load_normalize_en(script)
+    assert normalize_en("He's a boy.") == "he is a boy ."
+    assert normalize_en("don'that's") == normalize_en_loop("don'that's", contractions) == "do nothat is"
+    for sentence in CASES:
+        assert normalize_en(sentence) == normalize_en_loop(sentence, contractions), sentence
+
+
+def test_matches_ordered_passes(script):
+    normalize_en, contractions = load_normalize_en(script)
+    for sentence in random_sentences():
+        assert normalize_en(sentence) == normalize_en_loop(sentence, contractions), sentence
@@ -0,0 +1,139 @@
+"""Offline tests for the corpus resolver shared by the training scripts.
+
+The scripts train at import time, so only the resolver (CORPUS_* settings, file_sha256 and
+resolve_corpus) is pulled out of each script with ast and run against a temporary fixture
+corpus. urllib3 is replaced with a fake PoolManager, so no test touches the network.
+"""
+import ast
+import glob
+import hashlib
+import io
+import json
+import os
+import shutil
+
+import pytest
+
+ROOT    = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS = sorted(glob.glob(os.path.join(ROOT, '[0-9][0-9]_*.py')))
+
+URL    = 'https://example.com/data/corpus.csv'
+CORPUS = 'SRC,TRG\n안녕하세요,hello\n감사합니다,thank you\n'.encode('utf-8')
+DIGEST = hashlib.sha256(CORPUS).hexdigest()
+
+
+class FakeResponse(io.BytesIO):
+    def __init__(self, body, status=200):
+        super(FakeResponse, self).__init__(body)
+        self.status = status
+
+
+class FakeUrllib3(object):
+    """Stands in for the urllib3 module and records every requested URL."""
+    def __init__(self, body=CORPUS, status=200):
+        self.body, self.status, self.requests = body, status, []
+
+    def PoolManager(self):
+        return self
+
+    def request(self, method, url, preload_content=True):
+        self.requests.append((method, url))
+        return FakeResponse(self.body, self.status)
+
+
+def load_resolver(script, fake_urllib3):
+    with open(script, encoding='utf-8') as f:
+        tree = ast.parse(f.read(), script)
+
+    nodes = [node for node in tree.body
+             if (isinstance(node, ast.FunctionDef) and node.name in ('file_sha256', 'resolve_corpus'))
+             or (isinstance(node, ast.Assign) and all(isinstance(target, ast.Name) and target.id.startswith('CORPUS_')
+                                                     for target in node.targets))]
+    namespace = {'os': os, 'json': json, 'shutil': shutil, 'hashlib': hashlib, 'urllib3': fake_urllib3}
+    exec(compile(ast.Module(body=nodes, type_ignores=[]), script, 'exec'), namespace)
+    return namespace['resolve_corpus']
+
+
+@pytest.fixture(params=SCRIPTS, ids=os.path.basename)
+def script(request):
+    return request.param
+
+
+@pytest.fixture
+def corpus_file(tmp_path):
+    path = tmp_path / 'fixture' / 'corpus.csv'
+    path.parent.mkdir()
+    path.write_bytes(CORPUS)
+    return path
+
+
+def test_scripts_found():
+    assert len(SCRIPTS) == 12
+
+
+def test_override_file(script, corpus_file, tmp_path):
+    fake = FakeUrllib3()
+    resolve_corpus = load_resolver(script, fake)
+
+    for override in (str(corpus_file), 'file://' + str(corpus_file), str(corpus_file.parent)):
+        assert resolve_corpus(URL, DIGEST, override, str(tmp_path / 'cache')) == str(corpus_file)
+    assert fake.requests == []
+
+
+def test_override_errors(script, corpus_file, tmp_path):
+    resolve_corpus = load_resolver(script, FakeUrllib3())
+
+    with pytest.raises(FileNotFoundError):
+        resolve_corpus(URL, None, str(tmp_path / 'missing.csv'), str(tmp_path / 'cache'))
+    with pytest.raises(ValueError):
+        resolve_corpus(URL, '0' * 64, str(corpus_file), str(tmp_path / 'cache'))
+
+
+def test_download_then_cache_hit(script, tmp_path):
+    fake = FakeUrllib3()
+    resolve_corpus = load_resolver(script, fake)
+    cache_dir = str(tmp_path / 'cache')
+
+    path = resolve_corpus(URL, None, None, cache_dir)
+    assert os.path.basename(path) == DIGEST
+    with open(path, 'rb') as f:
+        assert f.read() == CORPUS
+    assert fake.requests == [('GET', URL)]
+
+    # 두 번째 호출은 urls/ 의 기록으로 blob 을 찾으므로 다시 받지 않는다.
+    assert resolve_corpus(URL, None, None, cache_dir) == path
+    assert resolve_corpus(URL, DIGEST, None, cache_dir) == path
+    assert fake.requests == [('GET', URL)]
+
+
+def test_corrupted_blob_is_downloaded_again(script, tmp_path):
+    fake = FakeUrllib3()
+    resolve_corpus = load_resolver(script, fake)
+    cache_dir = str(tmp_path / 'cache')
+
+    path = resolve_corpus(URL, DIGEST, None, cache_dir)
+    with open(path, 'wb') as f:
+        f.write(b'corrupted')
+
+    assert resolve_corpus(URL, DIGEST, None, cache_dir) == path
+    with open(path, 'rb') as f:
+        assert f.read() == CORPUS
+    assert len(fake.requests) == 2
+
+
+def test_download_checksum_mismatch(script, tmp_path):
+    resolve_corpus = load_resolver(script, FakeUrllib3(body=b'not the corpus'))
+    cache_dir = tmp_path / 'cache'
+
+    with pytest.raises(ValueError):
+        resolve_corpus(URL, DIGEST, None, str(cache_dir))
+    # 검증에 실패한 임시 파일은 cache 에 남지 않는다.
+    assert os.listdir(cache_dir / 'blobs') == []
+    assert os.listdir(cache_dir / 'urls') == []
+
+
+def test_download_http_error(script, tmp_path):
+    resolve_corpus = load_resolver(script, FakeUrllib3(body=b'', status=404))
+
+    with pytest.raises(IOError):
+        resolve_corpus(URL, None, None, str(tmp_path / 'cache'))